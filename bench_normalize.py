@@ -0,0 +1,72 @@
+import re
+import json
+import time
+import string
+import argparse
+import unicodedata
+
+from dsp.utils.metrics import normalize_text, normalize_many
+
+
+def normalize_text_reference(s):
+    # the previous, uncached implementation of dsp.utils.metrics.normalize_text
+    s = unicodedata.normalize('NFD', s)
+
+    def remove_articles(text):
+        return re.sub(r'\b(a|an|the)\b', ' ', text)
+
+    def white_space_fix(text):
+        return ' '.join(text.split())
+
+    def remove_punc(text):
+        exclude = set(string.punctuation)
+        return ''.join(ch for ch in text if ch not in exclude)
+
+    def lower(text):
+        return text.lower()
+
+    return white_space_fix(remove_articles(remove_punc(lower(s))))
+
+
+def get_asqa_answers(data_path):
+    data = json.load(open(data_path))
+    answers = []
+    for split in data.values():
+        for ins in split.values():
+            for qa_pair in ins['qa_pairs']:
+                answers += qa_pair['short_answers']
+            answers += [anns['long_answer'] for anns in ins['annotations']]
+    return answers
+
+
+def timed(func, answers, n_rounds):
+    start = time.perf_counter()
+    for _ in range(n_rounds):
+        func(answers)
+    return (time.perf_counter() - start) / n_rounds
+
+
+def main():
+    parser = argparse.ArgumentParser("Micro-benchmark of normalize_text on the ASQA answer set")
+    parser.add_argument("--data_path", default="asqa/ASQA.json", type=str, help="The ASQA dataset.")
+    parser.add_argument("--n_rounds", default=5, type=int, help="The number of passes over the answers.")
+    args = parser.parse_args()
+
+    answers = get_asqa_answers(args.data_path)
+    print(f"#> {len(answers)} answers ({len(set(answers))} distinct)")
+
+    assert [normalize_text_reference(ans) for ans in answers] == normalize_many(answers)
+
+    reference = timed(lambda xs: [normalize_text_reference(x) for x in xs], answers, args.n_rounds)
+
+    normalize_text.cache_clear()
+    cold = timed(lambda xs: [normalize_text.__wrapped__(x) for x in xs], answers, args.n_rounds)
+    warm = timed(normalize_many, answers, args.n_rounds)
+
+    print(f"#> reference:      {reference * 1000:.1f} ms per pass")
+    print(f"#> uncached:       {cold * 1000:.1f} ms per pass ({reference / cold:.1f}x)")
+    print(f"#> normalize_many: {warm * 1000:.1f} ms per pass ({reference / warm:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,22 @@
 import os
+import ast
+import json
+import time
+import pickle
+import sqlite3
+import asyncio
+import hashlib
+import argparse
+import threading
 
 from pathlib import Path
 from joblib import Memory
 from functools import wraps
+from collections import OrderedDict
+from concurrent.futures import Future
 
 from dsp.utils import dotdict
+from dsp.utils.settings import settings
 
 
 cache_turn_on = True
@@ -17,8 +29,173 @@ def noop_decorator(func):
     return wrapper
 
 
+def normalize_request(*args, **kwargs):
+    """Canonical JSON of a request. Chat requests arrive as a `stringify_request` JSON string, which is decoded
+    so that key order inside it doesn't matter."""
+    if isinstance(kwargs.get("stringify_request"), str):
+        kwargs = {**kwargs, "stringify_request": json.loads(kwargs["stringify_request"])}
+
+    return json.dumps({"args": args, "kwargs": kwargs}, sort_keys=True, default=str)
+
+
+class CompletionCache:
+    """Single-file SQLite store of LM completions, keyed on a hash of the function name and normalized kwargs.
+
+    The database runs in WAL mode, so several worker processes can read it while one writes. If `max_bytes`
+    is set, the least recently used completions are evicted once the stored values grow beyond it. Access times
+    of hits are buffered in memory and written with the next `set` or `evict`, so that reads don't write.
+    """
+
+    evict_every = 100
+
+    def __init__(self, path: str, max_bytes=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+        self.n_puts = 0
+        # key -> time of the last hit, not yet written to the database
+        self.accessed = {}
+        self.access_lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS completions "
+            "(key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS completions_last_access ON completions (last_access)")
+        conn.commit()
+
+    def _conn(self):
+        # sqlite connections can't be shared across threads, so each thread opens its own
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @staticmethod
+    def request_hash(name, *args, **kwargs):
+        return hashlib.sha256((name + "\0" + normalize_request(*args, **kwargs)).encode("utf-8")).hexdigest()
+
+    def __contains__(self, key):
+        return self._conn().execute("SELECT 1 FROM completions WHERE key = ?", (key,)).fetchone() is not None
+
+    def get(self, key):
+        """Returns (True, value) if `key` is cached and (False, None) otherwise."""
+        conn = self._conn()
+        row = conn.execute("SELECT value FROM completions WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return False, None
+
+        if self.max_bytes is not None:
+            with self.access_lock:
+                self.accessed[key] = time.time()
+
+        return True, pickle.loads(row[0])
+
+    def _write_accessed(self, conn):
+        with self.access_lock:
+            accessed, self.accessed = self.accessed, {}
+        if accessed:
+            conn.executemany(
+                "UPDATE completions SET last_access = ? WHERE key = ?",
+                [(last_access, key) for key, last_access in accessed.items()],
+            )
+
+    def set(self, key, value):
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        conn = self._conn()
+        self._write_accessed(conn)
+        conn.execute(
+            "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?)", (key, blob, len(blob), time.time())
+        )
+        conn.commit()
+
+        self.n_puts += 1
+        if self.max_bytes is not None and self.n_puts % self.evict_every == 0:
+            self.evict(self.max_bytes)
+
+    def evict(self, max_bytes):
+        """Deletes the least recently used completions until the stored values fit into `max_bytes`."""
+        conn = self._conn()
+        self._write_accessed(conn)
+        conn.commit()
+
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+        if total <= max_bytes:
+            return
+
+        to_delete = []
+        for key, size in conn.execute("SELECT key, size FROM completions ORDER BY last_access"):
+            if total <= max_bytes:
+                break
+            to_delete.append((key,))
+            total -= size
+
+        conn.executemany("DELETE FROM completions WHERE key = ?", to_delete)
+        conn.commit()
+
+    def cache(self, func):
+        """Decorator in the style of joblib's `Memory.cache`."""
+        name = func.__name__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            key = self.request_hash(name, *args, **kwargs)
+            found, value = self.get(key)
+            if found:
+                return value
+
+            value = func(*args, **kwargs)
+            self.set(key, value)
+            return value
+
+        def check_call_in_cache(*args, **kwargs):
+            return self.request_hash(name, *args, **kwargs) in self
+
+        wrapper.check_call_in_cache = check_call_in_cache
+        return wrapper
+
+
+def migrate_joblib_cache(joblib_dir, cache: CompletionCache, func_names=None):
+    """Copies the completions of a joblib cachedir into `cache`. Returns the number of migrated entries."""
+    import joblib
+
+    n_migrated = 0
+    for root, dirs, files in os.walk(joblib_dir):
+        if "metadata.json" not in files or "output.pkl" not in files:
+            continue
+
+        name = os.path.basename(os.path.dirname(root))
+        if func_names is not None and name not in func_names:
+            continue
+
+        try:
+            with open(os.path.join(root, "metadata.json")) as f:
+                input_args = json.load(f)["input_args"]
+            kwargs = ast.literal_eval(input_args.get("**", "{}"))
+            value = joblib.load(os.path.join(root, "output.pkl"))
+        except Exception as e:
+            print(f"#> Skipping {root}: {e}")
+            continue
+
+        cache.set(cache.request_hash(name, **kwargs), value)
+        n_migrated += 1
+
+    return n_migrated
+
+
 cachedir = os.environ.get('DSP_CACHEDIR') or os.path.join(Path.home(), 'cachedir_joblib')
-CacheMemory = Memory(location=cachedir, verbose=0)
+cache_max_bytes = os.environ.get('DSP_CACHE_MAX_BYTES')
+CacheMemory = CompletionCache(
+    os.path.join(cachedir, 'completions.sqlite'),
+    max_bytes=int(cache_max_bytes) if cache_max_bytes else None,
+)
+
+# upper bound of each in-process LRU tier in front of the persistent caches
+memory_cache_max_bytes = int(os.environ.get('DSP_MEMORY_CACHE_MAX_BYTES', 256 * 2 ** 20))
 
 cachedir2 = os.environ.get('DSP_NOTEBOOK_CACHEDIR')
 NotebookCacheMemory = dotdict()
@@ -28,9 +205,171 @@ if cachedir2:
     NotebookCacheMemory = Memory(location=cachedir2, verbose=0)
 
 
+def is_cached_call(func, **kwargs):
+    """Returns True if calling the cached `func` with `kwargs` would be served from its cache."""
+    check_call_in_cache = getattr(func, 'check_call_in_cache', None)
+    return check_call_in_cache is not None and check_call_in_cache(**kwargs)
+
+
+class MemoryCache:
+    """Thread-safe in-process LRU, bounded by the total (pickled) size of its values in bytes.
+
+    Hits, misses, evictions and resident bytes are tracked, and every cache is registered by `name` in
+    `dsp.settings.memory_caches`, so `dsp.settings.cache_stats()` reports all of them.
+    """
+
+    def __init__(self, name: str, max_bytes: int):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        settings.memory_caches[name] = self
+
+    def get(self, key):
+        """Returns (True, value) if `key` is cached and (False, None) otherwise."""
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+
+            self.hits += 1
+            self.data.move_to_end(key)
+            return True, entry[0]
+
+    def sizeof(self, value) -> int:
+        return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self.lock:
+            if key in self.data:
+                self.resident_bytes -= self.data.pop(key)[1]
+
+            if size > self.max_bytes:
+                return
+
+            self.data[key] = (value, size)
+            self.resident_bytes += size
+            self._evict()
+
+    def resize(self, max_bytes: int):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self):
+        while self.resident_bytes > self.max_bytes:
+            _, (_, size) = self.data.popitem(last=False)
+            self.resident_bytes -= size
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.data),
+            "resident_bytes": self.resident_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+    def cache(self, func):
+        """Decorator that memoizes `func` on its normalized arguments."""
+        name = func.__name__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            key = name + "\0" + normalize_request(*args, **kwargs)
+            found, value = self.get(key)
+            if found:
+                return value
+
+            value = func(*args, **kwargs)
+            self.put(key, value)
+            return value
+
+        return wrapper
+
+
+class InflightRequests:
+    """Coalesces identical requests: while a call for `key` is in flight, other callers with
+    the same key wait for its result instead of issuing their own call."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.futures: dict[str, Future] = {}
+
+    def _claim(self, key):
+        with self.lock:
+            future = self.futures.get(key)
+            if future is not None:
+                return future, False
+
+            future = self.futures[key] = Future()
+            return future, True
+
+    def _release(self, key):
+        with self.lock:
+            del self.futures[key]
+
+    def run(self, key, func, *args, **kwargs):
+        future, is_owner = self._claim(key)
+        if not is_owner:
+            return future.result()
+
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            self._release(key)
+
+        return result
+
+    async def arun(self, key, func, *args, **kwargs):
+        """Like `run`, but awaits the result and calls the (blocking) `func` in a worker thread."""
+        future, is_owner = self._claim(key)
+        if not is_owner:
+            return await asyncio.wrap_future(future)
+
+        try:
+            result = await asyncio.to_thread(func, *args, **kwargs)
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            self._release(key)
+
+        return result
+
+
 if not cache_turn_on:
     CacheMemory = dotdict()
     CacheMemory.cache = noop_decorator
 
     NotebookCacheMemory = dotdict()
     NotebookCacheMemory.cache = noop_decorator
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Migrate a joblib LM cache into the SQLite completion cache")
+    parser.add_argument("--joblib_dir", default=os.path.join(cachedir, 'joblib'), type=str, help="The joblib cachedir.")
+    parser.add_argument("--cache_path", default=os.path.join(cachedir, 'completions.sqlite'), type=str,
+                        help="The SQLite completion cache.")
+    parser.add_argument("--funcs", default="cached_gpt3_request_v2,_cached_gpt3_turbo_request_v2", type=str,
+                        help="Comma-separated names of the cached functions to migrate.")
+    args = parser.parse_args()
+
+    n_migrated = migrate_joblib_cache(args.joblib_dir, CompletionCache(args.cache_path), args.funcs.split(","))
+    print(f"#> Migrated {n_migrated} completions into {args.cache_path}")
@@ -1,5 +1,5 @@
 import math
-from typing import Any, Optional
+from typing import Optional
 import backoff
 
 from dsp.modules.lm import LM
@@ -68,25 +68,16 @@ class Cohere(LM):
         self.stop_sequences = stop_sequences
         self.max_num_generations = 5
 
-        self.history: list[dict[str, Any]] = []
-
     def basic_request(self, prompt: str, **kwargs):
         raw_kwargs = kwargs
         kwargs = {
             **self.kwargs,
             "stop_sequences": self.stop_sequences,
-            "prompt": prompt,
             **kwargs,
         }
-        response = self.co.generate(**kwargs)
+        response = self.co.generate(prompt=prompt, **kwargs)
 
-        history = {
-            "prompt": prompt,
-            "response": response,
-            "kwargs": kwargs,
-            "raw_kwargs": raw_kwargs,
-        }
-        self.history.append(history)
+        self.history.append(prompt, response, kwargs, raw_kwargs)
 
         return response
 
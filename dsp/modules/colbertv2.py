@@ -1,76 +1,155 @@
-import functools
+import os
+import json
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, Union, Any
+
 import requests
+from requests.adapters import HTTPAdapter
 
-from dsp.modules.cache_utils import CacheMemory, NotebookCacheMemory
+from dsp.modules.cache_utils import MemoryCache, cachedir, cache_turn_on, memory_cache_max_bytes
 from dsp.utils import dotdict
 
 
 # TODO: Ideally, this takes the name of the index and looks up its port.
 
 
+class RetrievalCache:
+    """Cache of top-k retrieval results keyed by (url, query), with a byte-bounded in-memory LRU in front
+    of an optional SQLite file. Only the largest k fetched for a query is kept, and requests for a
+    smaller k are served from it.
+    """
+
+    def __init__(self, name: str, max_bytes: int = memory_cache_max_bytes, path: Optional[str] = None):
+        self.memory = MemoryCache(name, max_bytes)
+        self.lock = threading.Lock()
+
+        self.conn = None
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS topk "
+                "(url TEXT, query TEXT, k INTEGER, topk TEXT, PRIMARY KEY (url, query))"
+            )
+            self.conn.commit()
+
+    def get(self, url: str, query: str, k: int) -> Optional[list[dict[str, Any]]]:
+        key = (url, query)
+        found, entry = self.memory.get(key)
+        # the memory entry may hold a smaller k than the disk, if it was evicted and put again since
+        if (entry is None or entry[0] < k) and self.conn is not None:
+            with self.lock:
+                row = self.conn.execute(
+                    "SELECT k, topk FROM topk WHERE url = ? AND query = ?", key
+                ).fetchone()
+            if row is not None and (entry is None or row[0] > entry[0]):
+                entry = (row[0], json.loads(row[1]))
+                self.memory.put(key, entry)
+
+        if entry is None or entry[0] < k:
+            return None
+
+        return entry[1][:k]
+
+    def put(self, url: str, query: str, k: int, topk: list[dict[str, Any]]):
+        key = (url, query)
+        # peek without counting a hit / miss in the cache stats
+        with self.memory.lock:
+            entry = self.memory.data.get(key)
+        if entry is not None and entry[0][0] >= k:
+            return
+
+        if self.conn is not None:
+            with self.lock:
+                cursor = self.conn.execute(
+                    "INSERT INTO topk VALUES (?, ?, ?, ?) ON CONFLICT (url, query) "
+                    "DO UPDATE SET k = excluded.k, topk = excluded.topk WHERE excluded.k > topk.k",
+                    (url, query, k, json.dumps(topk)),
+                )
+                self.conn.commit()
+            if cursor.rowcount == 0:
+                # the disk holds a larger k; keep the memory from shrinking below it
+                return
+
+        self.memory.put(key, (k, topk))
+
+
 class ColBERTv2:
-    """Wrapper for the ColBERTv2 Retrieval."""
+    """Wrapper for the ColBERTv2 Retrieval.
+
+    Requests go through a pooled keep-alive session, and results are cached in memory (up to `cache_max_bytes`)
+    and on disk (`cache_path`, by default in the DSP cache directory).
+    """
 
     def __init__(
         self,
         url: str = "http://0.0.0.0",
         port: Optional[Union[str, int]] = None,
         post_requests: bool = False,
+        cache_max_bytes: int = memory_cache_max_bytes,
+        cache_path: Optional[str] = None,
+        timeout: float = 10,
+        max_workers: int = 8,
     ):
         self.post_requests = post_requests
         self.url = f"{url}:{port}" if port else url
+        self.timeout = timeout
+        self.max_workers = max_workers
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        if cache_path is None and cache_turn_on:
+            cache_path = os.path.join(cachedir, "colbertv2.sqlite")
+        self.cache = RetrievalCache(
+            f"colbertv2:{self.url}", max_bytes=cache_max_bytes if cache_turn_on else 0, path=cache_path
+        )
 
     def __call__(
         self, query: str, k: int = 10, simplify: bool = False
     ) -> Union[list[str], list[dotdict]]:
-        if self.post_requests:
-            topk: list[dict[str, Any]] = colbertv2_post_request(self.url, query, k)
-        else:
-            topk: list[dict[str, Any]] = colbertv2_get_request(self.url, query, k)
+        topk = self.cache.get(self.url, query, k)
+        if topk is None:
+            if self.post_requests:
+                topk: list[dict[str, Any]] = self._post_request(query, k)
+            else:
+                topk: list[dict[str, Any]] = self._get_request(query, k)
+            self.cache.put(self.url, query, k, topk)
 
         if simplify:
             return [psg["long_text"] for psg in topk]
 
         return [dotdict(psg) for psg in topk]
 
+    def search_many(
+        self, queries: list[str], k: int = 10, simplify: bool = False
+    ) -> list[Union[list[str], list[dotdict]]]:
+        """Retrieves the top-k passages of all queries with concurrent requests, in the order of `queries`."""
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(lambda query: self(query, k=k, simplify=simplify), queries))
 
-@CacheMemory.cache
-def colbertv2_get_request_v2(url: str, query: str, k: int):
-    assert (
-        k <= 100
-    ), "Only k <= 100 is supported for the hosted ColBERTv2 server at the moment."
-
-    payload = {"query": query, "k": k}
-    res = requests.get(url, params=payload, timeout=10)
-
-    topk = res.json()["topk"][:k]
-    topk = [{**d, "long_text": d["text"]} for d in topk]
-    return topk[:k]
-
-
-@functools.lru_cache(maxsize=None)
-@NotebookCacheMemory.cache
-def colbertv2_get_request_v2_wrapped(*args, **kwargs):
-    return colbertv2_get_request_v2(*args, **kwargs)
-
-
-colbertv2_get_request = colbertv2_get_request_v2_wrapped
-
-
-@CacheMemory.cache
-def colbertv2_post_request_v2(url: str, query: str, k: int):
-    headers = {"Content-Type": "application/json; charset=utf-8"}
-    payload = {"query": query, "k": k}
-    res = requests.post(url, json=payload, headers=headers, timeout=10)
+    def _get_request(self, query: str, k: int) -> list[dict[str, Any]]:
+        assert (
+            k <= 100
+        ), "Only k <= 100 is supported for the hosted ColBERTv2 server at the moment."
 
-    return res.json()["topk"][:k]
+        payload = {"query": query, "k": k}
+        res = self.session.get(self.url, params=payload, timeout=self.timeout)
 
+        return self._parse_topk(res, k)
 
-@functools.lru_cache(maxsize=None)
-@NotebookCacheMemory.cache
-def colbertv2_post_request_v2_wrapped(*args, **kwargs):
-    return colbertv2_post_request_v2(*args, **kwargs)
+    def _post_request(self, query: str, k: int) -> list[dict[str, Any]]:
+        headers = {"Content-Type": "application/json; charset=utf-8"}
+        payload = {"query": query, "k": k}
+        res = self.session.post(self.url, json=payload, headers=headers, timeout=self.timeout)
 
+        return self._parse_topk(res, k)
 
-colbertv2_post_request = colbertv2_post_request_v2_wrapped
+    @staticmethod
+    def _parse_topk(res, k: int) -> list[dict[str, Any]]:
+        topk = res.json()["topk"][:k]
+        return [{**d, "long_text": d.get("long_text", d["text"])} for d in topk]
@@ -1,4 +1,4 @@
-import functools
+import asyncio
 import json
 from typing import Any, Literal, Optional, cast
 
@@ -7,8 +7,19 @@ import openai
 import openai.error
 from openai.openai_object import OpenAIObject
 
-from dsp.modules.cache_utils import CacheMemory, NotebookCacheMemory, cache_turn_on
+from dsp.modules.cache_utils import (
+    CacheMemory, NotebookCacheMemory, InflightRequests, MemoryCache,
+    cache_turn_on, is_cached_call, memory_cache_max_bytes, normalize_request
+)
 from dsp.modules.lm import LM
+from dsp.utils.settings import settings
+
+
+def wait_for_rate_limit(cached_func, **kwargs):
+    """Blocks on the configured `rate_limiter` unless the request will be served from the cache."""
+    rate_limiter = settings.rate_limiter
+    if rate_limiter is not None and not is_cached_call(cached_func, **kwargs):
+        rate_limiter.acquire()
 
 
 def backoff_hdlr(details):
@@ -68,31 +79,29 @@ class GPT3(LM):
         }  # TODO: add kwargs above for </s>
         if api_provider == "openai":
             self.kwargs["model"] = model
-        self.history: list[dict[str, Any]] = []
+        self.inflight = InflightRequests()
 
     def basic_request(self, prompt: str, **kwargs) -> OpenAIObject:
         raw_kwargs = kwargs
 
         kwargs = {**self.kwargs, **kwargs}
+        # the history keeps the prompt once, so record the kwargs before the prompt is added
+        history_kwargs = dict(kwargs)
         if self.model_type == "chat":
             # caching mechanism requires hashable kwargs
             kwargs["messages"] = [{"role": "user", "content": prompt}]
             kwargs = {
                 "stringify_request": json.dumps(kwargs)
             }
+            wait_for_rate_limit(_cached_gpt3_turbo_request_v2, **kwargs)
             response = cached_gpt3_turbo_request(**kwargs)
             
         else:
             kwargs["prompt"] = prompt
+            wait_for_rate_limit(cached_gpt3_request_v2, **kwargs)
             response = cached_gpt3_request(**kwargs)
 
-        history = {
-            "prompt": prompt,
-            "response": response,
-            "kwargs": kwargs,
-            "raw_kwargs": raw_kwargs,
-        }
-        self.history.append(history)
+        self.history.append(prompt, response, history_kwargs, raw_kwargs)
 
         return response
 
@@ -135,13 +144,54 @@ class GPT3(LM):
         assert only_completed, "for now"
         assert return_sorted is False, "for now"
 
+        kwargs = self._prepare_kwargs(**kwargs)
+        response = self.inflight.run(
+            normalize_request(prompt, **kwargs), self.request, prompt, **kwargs
+        )
+
+        return self._get_completions(response, only_completed, return_sorted, **kwargs)
+
+    async def acall(
+        self,
+        prompt: str,
+        only_completed: bool = True,
+        return_sorted: bool = False,
+        **kwargs,
+    ) -> list[dict[str, Any]]:
+        """Async version of `__call__`. Identical requests in flight at the same time share one API call."""
+
+        assert only_completed, "for now"
+        assert return_sorted is False, "for now"
+
+        kwargs = self._prepare_kwargs(**kwargs)
+        response = await self.inflight.arun(
+            normalize_request(prompt, **kwargs), self.request, prompt, **kwargs
+        )
+
+        return self._get_completions(response, only_completed, return_sorted, **kwargs)
+
+    async def agenerate(
+        self, prompts: list[str], **kwargs
+    ) -> list[list[dict[str, Any]]]:
+        """Retrieves completions for all `prompts` concurrently, in the order of `prompts`."""
+        return await asyncio.gather(*[self.acall(prompt, **kwargs) for prompt in prompts])
+
+    def _prepare_kwargs(self, **kwargs) -> dict[str, Any]:
         if kwargs.get("n", 1) > 1:
             if self.model_type == "chat":
                 kwargs = {**kwargs}
             else:
                 kwargs = {**kwargs, "logprobs": 5}
 
-        response = self.request(prompt, **kwargs)
+        return kwargs
+
+    def _get_completions(
+        self,
+        response: OpenAIObject,
+        only_completed: bool = True,
+        return_sorted: bool = False,
+        **kwargs,
+    ) -> list[dict[str, Any]]:
         choices = response["choices"]
 
         completed_choices = [c for c in choices if c["finish_reason"] != "length"]
@@ -178,7 +228,10 @@ def cached_gpt3_request_v2(**kwargs):
     return openai.Completion.create(**kwargs)
 
 
-@functools.lru_cache(maxsize=None if cache_turn_on else 0)
+gpt3_memory_cache = MemoryCache("gpt3", max_bytes=memory_cache_max_bytes if cache_turn_on else 0)
+
+
+@gpt3_memory_cache.cache
 @NotebookCacheMemory.cache
 def cached_gpt3_request_v2_wrapped(**kwargs):
     return cached_gpt3_request_v2(**kwargs)
@@ -194,7 +247,7 @@ def _cached_gpt3_turbo_request_v2(**kwargs) -> OpenAIObject:
     return cast(OpenAIObject, openai.ChatCompletion.create(**kwargs))
 
 
-@functools.lru_cache(maxsize=None if cache_turn_on else 0)
+@gpt3_memory_cache.cache
 @NotebookCacheMemory.cache
 def _cached_gpt3_turbo_request_v2_wrapped(**kwargs) -> OpenAIObject:
     return _cached_gpt3_turbo_request_v2(**kwargs)
@@ -1,5 +1,10 @@
+import copy
 from typing import Optional, Literal
 from dsp.modules.lm import LM
+from dsp.modules.cache_utils import CacheMemory, MemoryCache, cache_turn_on
+
+# TemplateV2 joins the instructions, guidelines, demos and query of a prompt with this separator
+TEMPLATE_SEPARATOR = "\n\n---\n\n"
 
 
 def openai_to_hf(**kwargs):
@@ -21,9 +26,37 @@ def openai_to_hf(**kwargs):
     return hf_kwargs
 
 
+def split_prefix(prompt):
+    """Returns the part of the prompt that is shared with other prompts: everything up to the last template
+    separator (the instructions and demos) or, for prompts without one, the first line (the instruction)."""
+    offset = prompt.rfind(TEMPLATE_SEPARATOR)
+    if offset >= 0:
+        return prompt[: offset + len(TEMPLATE_SEPARATOR)]
+
+    offset = prompt.find("\n")
+    return prompt[: offset + 1] if offset >= 0 else ""
+
+
+def _nbytes(obj):
+    if hasattr(obj, "key_cache"):
+        # transformers' Cache objects (e.g. DynamicCache)
+        return _nbytes(obj.key_cache) + _nbytes(obj.value_cache)
+    if isinstance(obj, (tuple, list)):
+        return sum(_nbytes(x) for x in obj)
+    return getattr(obj, "nbytes", 0)
+
+
+class PrefixKVCache(MemoryCache):
+    """LRU of the (input ids, past_key_values) of prompt prefixes, bounded by the memory of their tensors."""
+
+    def sizeof(self, value) -> int:
+        return _nbytes(value)
+
+
 class HFModel(LM):
     def __init__(self, model: str, checkpoint: Optional[str] = None, is_client: bool = False,
-                 hf_device_map: Literal["auto", "balanced", "balanced_low_0", "sequential"] = "auto"):
+                 hf_device_map: Literal["auto", "balanced", "balanced_low_0", "sequential"] = "auto",
+                 prefix_cache_max_bytes: int = 2 ** 30):
         """wrapper for Hugging Face models
 
         Args:
@@ -32,6 +65,8 @@ class HFModel(LM):
             is_client (bool, optional): whether to access models via client. Defaults to False.
             hf_device_map (str, optional): HF config strategy to load the model. 
                 Recommeded to use "auto", which will help loading large models using accelerate. Defaults to "auto".
+            prefix_cache_max_bytes (int, optional): memory for the past_key_values of shared prompt prefixes
+                (see `split_prefix`), which causal models compute once and reuse. 0 disables it. Defaults to 1GB.
         """
         try:
             from transformers import AutoModelForSeq2SeqLM, AutoModelForCausalLM, AutoTokenizer
@@ -44,6 +79,7 @@ class HFModel(LM):
         self.provider = "hf"
         self.is_client = is_client
         self.device_map = hf_device_map
+        self.checkpoint = checkpoint
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         if not self.is_client:
             try:
@@ -59,28 +95,50 @@ class HFModel(LM):
                 )
                 self.drop_prompt_from_output = True
             self.tokenizer = AutoTokenizer.from_pretrained(model)
-        self.history = []
+
+        self.prefix_cache = None
+        if not self.is_client and self.drop_prompt_from_output and prefix_cache_max_bytes > 0:
+            self.prefix_cache = PrefixKVCache(f"hf_prefix:{model}", max_bytes=prefix_cache_max_bytes)
 
     def basic_request(self, prompt, **kwargs):
         raw_kwargs = kwargs
         kwargs = {**self.kwargs, **kwargs}
-        response = self._generate(prompt, **kwargs)
+        response = self._cached_generate(prompt, **kwargs)
 
-        history = {
-            "prompt": prompt,
-            "response": response,
-            "kwargs": kwargs,
-            "raw_kwargs": raw_kwargs,
-        }
-        self.history.append(history)
+        self.history.append(prompt, response, kwargs, raw_kwargs)
+
+        return response
+
+    def _cache_key(self, prompt, **kwargs):
+        """Key of the completion in the persistent cache, or None if the generation samples and can't be cached."""
+        hf_kwargs = {**openai_to_hf(**self.kwargs), **openai_to_hf(**kwargs)}
+        if not cache_turn_on or hf_kwargs.get("do_sample"):
+            return None
+
+        return CacheMemory.request_hash(
+            "hf_generate", model=self.kwargs["model"], checkpoint=self.checkpoint, prompt=prompt, **hf_kwargs
+        )
+
+    def _cached_generate(self, prompt, **kwargs):
+        # greedy and beam search are deterministic, so their completions are cached like GPT-3's
+        key = self._cache_key(prompt, **kwargs)
+        if key is None:
+            return self._generate(prompt, **kwargs)
+
+        found, response = CacheMemory.get(key)
+        if not found:
+            response = self._generate(prompt, **kwargs)
+            CacheMemory.set(key, response)
 
         return response
 
     def _generate(self, prompt, **kwargs):
         assert not self.is_client
-        # TODO: Add caching
         kwargs = {**openai_to_hf(**self.kwargs), **openai_to_hf(**kwargs)}
         inputs = self.tokenizer(prompt, return_tensors="pt").to(self.device)
+        past_key_values = self._get_prefix_past(prompt, inputs.input_ids, kwargs)
+        if past_key_values is not None:
+            kwargs["past_key_values"] = past_key_values
         outputs = self.model.generate(**inputs, **kwargs)
         if self.drop_prompt_from_output:
             input_length = inputs.input_ids.shape[1]
@@ -95,6 +153,118 @@ class HFModel(LM):
         }
         return response
 
+    def _get_prefix_past(self, prompt, input_ids, hf_kwargs):
+        """Returns the past_key_values of all but the last token of the prompt, starting from the cached ones
+        of its shared prefix (computed on a miss), or None if they can't be reused for this generation.
+
+        With a past, generate() only runs the last token of `input_ids`, so the tokens between the prefix
+        and the last one are run here first.
+        """
+        # generate() would have to expand the cache for several beams / sequences
+        if (
+            self.prefix_cache is None
+            or hf_kwargs.get("num_beams", 1) > 1
+            or hf_kwargs.get("num_return_sequences", 1) > 1
+        ):
+            return None
+
+        prefix = split_prefix(prompt)
+        if not prefix:
+            return None
+
+        import torch
+
+        found, entry = self.prefix_cache.get(prefix)
+        if not found:
+            prefix_ids = self.tokenizer(prefix, return_tensors="pt").input_ids.to(self.device)
+            with torch.no_grad():
+                past_key_values = self.model(input_ids=prefix_ids, use_cache=True).past_key_values
+            entry = (prefix_ids, past_key_values)
+            self.prefix_cache.put(prefix, entry)
+
+        prefix_ids, past_key_values = entry
+        prefix_length = prefix_ids.shape[1]
+        # the prefix has to tokenize the same inside the prompt, and leave at least one token to run
+        if prefix_length >= input_ids.shape[1] or not torch.equal(input_ids[0, :prefix_length], prefix_ids[0]):
+            return None
+
+        # newer Cache objects are extended in place, so each generation continues from its own copy;
+        # the legacy tuples are only ever replaced, and can be shared
+        if hasattr(past_key_values, "key_cache"):
+            past_key_values = copy.deepcopy(past_key_values)
+
+        suffix_ids = input_ids[:, prefix_length:-1]
+        if suffix_ids.shape[1] > 0:
+            with torch.no_grad():
+                past_key_values = self.model(
+                    input_ids=suffix_ids,
+                    attention_mask=torch.ones_like(input_ids[:, :-1]),
+                    past_key_values=past_key_values,
+                    use_cache=True,
+                ).past_key_values
+
+        return past_key_values
+
+    def generate_batch(self, prompts, batch_size=8, **kwargs):
+        """Generates completions for several prompts (with the same kwargs), `batch_size` prompts at a time.
+        Returns one response per prompt, in order, as `_generate` does.
+        """
+        assert not self.is_client
+        kwargs = {**openai_to_hf(**self.kwargs), **openai_to_hf(**kwargs)}
+        # causal models continue the last token of the prompt, so they have to be padded on the left
+        self.tokenizer.padding_side = "left" if self.drop_prompt_from_output else "right"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+        # batches of prompts of similar length need less padding, so run the prompts sorted by length
+        encodings = self.tokenizer(prompts)
+        order = sorted(range(len(prompts)), key=lambda idx: len(encodings["input_ids"][idx]))
+
+        responses = [None] * len(prompts)
+        for offset in range(0, len(order), batch_size):
+            bucket = order[offset: offset + batch_size]
+            inputs = self.tokenizer.pad(
+                {key: [encodings[key][idx] for idx in bucket] for key in encodings.keys()},
+                return_tensors="pt",
+            ).to(self.device)
+            outputs = self.model.generate(**inputs, **kwargs)
+            if self.drop_prompt_from_output:
+                # with left padding, the prompt of every row ends at the same column
+                input_length = inputs["input_ids"].shape[1]
+                outputs = outputs[:, input_length:]
+            texts = self.tokenizer.batch_decode(outputs, skip_special_tokens=True)
+
+            # generate() returns the num_return_sequences sequences of each prompt next to each other
+            n = len(texts) // len(bucket)
+            for row, idx in enumerate(bucket):
+                responses[idx] = {
+                    "prompt": prompts[idx],
+                    "choices": [{"text": c} for c in texts[row * n: (row + 1) * n]],
+                }
+
+        return responses
+
+    def generate_many(self, prompts, **kwargs):
+        """Batched `__call__`: returns the completions of each of the prompts, in order."""
+        if kwargs.get("n", 1) > 1:
+            kwargs["num_beams"] = max(5, kwargs["n"])
+
+        keys = [self._cache_key(prompt, **kwargs) for prompt in prompts]
+        responses = [CacheMemory.get(key) if key is not None else (False, None) for key in keys]
+        misses = [idx for idx, (found, _) in enumerate(responses) if not found]
+        responses = [response for _, response in responses]
+
+        if misses:
+            for idx, response in zip(misses, self.generate_batch([prompts[idx] for idx in misses], **kwargs)):
+                responses[idx] = response
+                if keys[idx] is not None:
+                    CacheMemory.set(keys[idx], response)
+
+        for prompt, response in zip(prompts, responses):
+            self.history.append(prompt, response, {**self.kwargs, **kwargs}, kwargs)
+
+        return [[c["text"] for c in response["choices"]] for response in responses]
+
     def __call__(self, prompt, only_completed=True, return_sorted=False, **kwargs):
         assert only_completed, "for now"
         assert return_sorted is False, "for now"
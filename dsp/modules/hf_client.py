@@ -1,19 +1,69 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from dsp.modules.hf import HFModel
 
 
 class HFModelClient(HFModel):
-    def __init__(self, port, model, url="http://0.0.0.0"):
+    """Client of `dsp.modules.hf_server`.
+
+    Requests go through a pooled keep-alive session with a timeout, and are retried on connection errors
+    and 5xx responses. `generate_many` sends the prompts concurrently, in chunks to the server's
+    /batch endpoint (or one prompt per request if `use_batch_endpoint` is False).
+    """
+
+    def __init__(
+        self,
+        port,
+        model,
+        url="http://0.0.0.0",
+        timeout: float = 120,
+        max_retries: int = 3,
+        max_workers: int = 8,
+        use_batch_endpoint: bool = True,
+    ):
         super().__init__(model=model, is_client=True)
         self.url = f"{url}:{port}"
         self.headers = {"Content-Type": "application/json; charset=utf-8"}
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.use_batch_endpoint = use_batch_endpoint
+
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=0.5,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset(["POST"]),
+        )
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
     def _generate(self, prompt, **kwargs):
-        payload = {"prompt": prompt, **kwargs}
-        response = requests.post(self.url, json=payload, headers=self.headers)
+        return self._post(self.url, {"prompt": prompt, "kwargs": kwargs})
+
+    def generate_batch(self, prompts, batch_size=8, **kwargs):
+        """Sends the prompts to the server concurrently and returns one response per prompt, in order."""
+        # send the same merged kwargs as basic_request does, which is also what the cache key is built from
+        kwargs = {**self.kwargs, **kwargs}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            if not self.use_batch_endpoint:
+                return list(executor.map(lambda prompt: self._generate(prompt, **kwargs), prompts))
+
+            chunks = [prompts[offset: offset + batch_size] for offset in range(0, len(prompts), batch_size)]
+            responses = executor.map(
+                lambda chunk: self._post(f"{self.url}/batch", {"prompts": chunk, "kwargs": kwargs}), chunks
+            )
+            return [response for chunk_responses in responses for response in chunk_responses]
+
+    def _post(self, url, payload):
+        response = self.session.post(url, json=payload, headers=self.headers, timeout=self.timeout)
         try:
             return response.json()
-        except:
+        except ValueError:
             print("Failed to parse JSON response:", response.text)
             raise Exception("Received invalid JSON response from server")
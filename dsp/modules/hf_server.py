@@ -2,25 +2,29 @@
 # python -m dsp.modules.hf_server --port 4242 --model "google/flan-t5-base"
 
 # To Query:
-# curl -d '{"prompt":".."}' -X POST "http://0.0.0.0:4242" -H 'Content-Type: application/json'
-# Or use the HF client. TODO: Add support for kwargs to the server.
+# curl -d '{"prompt":"..", "kwargs":{"max_tokens":50}}' -X POST "http://0.0.0.0:4242" -H 'Content-Type: application/json'
+# curl -d '{"prompts":["..", ".."]}' -X POST "http://0.0.0.0:4242/batch" -H 'Content-Type: application/json'
+# curl "http://0.0.0.0:4242/metrics"
+# Or use the HF client.
+#
+# Requests are queued and, within a short window (--batch_window_ms), grouped by their generation kwargs
+# and run through the model as one padded batch (of at most --max_batch_size prompts).
 
 
-from functools import lru_cache
 import argparse
+import asyncio
+import json
 import time
-import random
-import os
-import sys
+from collections import deque
 import uvicorn
 import warnings
 
 from fastapi import FastAPI
 from pydantic import BaseModel
-from argparse import ArgumentParser
 from starlette.middleware.cors import CORSMiddleware
 
-from dsp.modules.hf import HFModel
+from dsp.modules.hf import HFModel, openai_to_hf
+from dsp.modules.cache_utils import MemoryCache
 
 
 class Query(BaseModel):
@@ -28,6 +32,93 @@ class Query(BaseModel):
     kwargs: dict = {}
 
 
+class BatchQuery(BaseModel):
+    prompts: list[str]
+    kwargs: dict = {}
+
+
+class BatchScheduler:
+    """Queues prompts and runs those with the same generation kwargs together through `lm.generate_batch`."""
+
+    def __init__(self, lm: HFModel, max_batch_size: int = 8, window: float = 0.01, n_latencies: int = 1000):
+        self.lm = lm
+        self.max_batch_size = max_batch_size
+        self.window = window
+        self.queue = None
+
+        self.n_requests = 0
+        self.n_batches = 0
+        self.latencies = deque(maxlen=n_latencies)
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        # keep a reference, the event loop only holds a weak one
+        self.task = asyncio.create_task(self._run())
+
+    async def submit(self, prompt: str, kwargs: dict) -> dict:
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((prompt, kwargs, future, time.time()))
+        return await future
+
+    async def _run(self):
+        while True:
+            # wait for a first request, then gather whatever arrives within the window
+            pending = [await self.queue.get()]
+            deadline = time.time() + self.window
+            while time.time() < deadline:
+                try:
+                    pending.append(await asyncio.wait_for(self.queue.get(), deadline - time.time()))
+                except asyncio.TimeoutError:
+                    break
+
+            groups = {}
+            for item in pending:
+                groups.setdefault(json.dumps(item[1], sort_keys=True), []).append(item)
+
+            for group in groups.values():
+                for offset in range(0, len(group), self.max_batch_size):
+                    batch = group[offset: offset + self.max_batch_size]
+                    try:
+                        await self._run_batch(batch)
+                    except Exception as exc:
+                        # a failed batch only fails its own requests, the scheduler keeps serving
+                        for _, _, future, _ in batch:
+                            if not future.done():
+                                future.set_exception(exc)
+
+    async def _run_batch(self, batch):
+        # requests whose handler was cancelled (e.g. the client disconnected) are dropped
+        batch = [item for item in batch if not item[2].done()]
+        if not batch:
+            return
+
+        prompts = [prompt for prompt, _, _, _ in batch]
+        kwargs = batch[0][1]
+        responses = await asyncio.to_thread(self.lm.generate_batch, prompts, **kwargs)
+
+        self.n_batches += 1
+        self.n_requests += len(batch)
+        for (_, _, future, start), response in zip(batch, responses):
+            latency = (time.time() - start) * 1000.0
+            self.latencies.append(latency)
+            if not future.done():
+                future.set_result({**response, "latency": latency})
+
+    def metrics(self) -> dict:
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            return latencies[min(int(p * len(latencies)), len(latencies) - 1)] if latencies else None
+
+        return {
+            "queue_depth": self.queue.qsize() if self.queue is not None else 0,
+            "requests": self.n_requests,
+            "batches": self.n_batches,
+            "mean_batch_size": self.n_requests / self.n_batches if self.n_batches else None,
+            "latency_ms": {"p50": percentile(0.5), "p95": percentile(0.95), "max": percentile(1.0)},
+        }
+
+
 warnings.filterwarnings("ignore")
 
 app = FastAPI()
@@ -38,30 +129,50 @@ app.add_middleware(
 parser = argparse.ArgumentParser("Server for Hugging Face models")
 parser.add_argument("--port", type=int, required=True, help="Server port")
 parser.add_argument("--model", type=str, required=True, help="Hugging Face model")
+parser.add_argument("--max_batch_size", type=int, default=8, help="Maximum number of prompts per batch")
+parser.add_argument("--batch_window_ms", type=float, default=10, help="How long to wait for requests to batch")
+parser.add_argument("--cache_max_bytes", type=int, default=256 * 2 ** 20, help="Size of the response cache")
 args = parser.parse_args()
 # TODO: Convert this to a log message
 print(f"#> Loading the language model {args.model}")
 lm = HFModel(args.model)
+scheduler = BatchScheduler(lm, max_batch_size=args.max_batch_size, window=args.batch_window_ms / 1000.0)
+response_cache = MemoryCache("hf_server", max_bytes=args.cache_max_bytes)
+
+
+async def generate(prompt, kwargs):
+    # sampled generations are expected to differ between requests, so only deterministic ones are cached
+    if {**openai_to_hf(**lm.kwargs), **openai_to_hf(**kwargs)}.get("do_sample"):
+        return await scheduler.submit(prompt, kwargs)
 
+    key = json.dumps([prompt, kwargs], sort_keys=True)
+    found, response = response_cache.get(key)
+    if found:
+        return response
 
-@lru_cache(maxsize=None)
-def generate(prompt, **kwargs):
-    global lm
-    generateStart = time.time()
-    # TODO: Convert this to a log message
-    print(f'#> kwargs: "{kwargs}" (type={type(kwargs)})')
-    response = lm._generate(prompt, **kwargs)
-    # TODO: Convert this to a log message
-    print(f'#> Response: "{response}"')
-    latency = (time.time() - generateStart) * 1000.0
-    response["latency"] = latency
-    print(f'#> Latency:', '{:.3f}'.format(latency / 1000.0), 'seconds')
+    response = await scheduler.submit(prompt, kwargs)
+    response_cache.put(key, response)
     return response
 
 
+@app.on_event("startup")
+async def start_scheduler():
+    scheduler.start()
+
+
 @app.post("/")
 async def generate_post(query: Query):
-    return generate(query.prompt, **query.kwargs)
+    return await generate(query.prompt, query.kwargs)
+
+
+@app.post("/batch")
+async def generate_batch_post(query: BatchQuery):
+    return await asyncio.gather(*[generate(prompt, query.kwargs) for prompt in query.prompts])
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return {**scheduler.metrics(), "cache": response_cache.stats()}
 
 
 if __name__ == "__main__":
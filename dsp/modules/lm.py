@@ -1,4 +1,131 @@
+import os
+import json
+import hashlib
+import threading
 from abc import ABC, abstractmethod
+from collections import deque
+from typing import Any, Optional
+
+
+class HistoryRecord:
+    """One LM call. The prompt is kept once per distinct prompt in the owning `LMHistory`, by hash."""
+
+    __slots__ = ("prompt_hash", "response", "kwargs", "raw_kwargs", "extras", "response_has_prompt")
+
+    def __init__(self, prompt_hash: str, response, kwargs: dict, raw_kwargs: dict, response_has_prompt=False):
+        self.prompt_hash = prompt_hash
+        self.response = response
+        self.kwargs = kwargs
+        self.raw_kwargs = raw_kwargs
+        self.extras = None
+        # e.g. HF responses repeat the prompt; it is dropped from them and added back on access
+        self.response_has_prompt = response_has_prompt
+
+
+class LMHistory:
+    """Ring buffer of the last `capacity` LM calls.
+
+    Records that fall out of the buffer are appended to the JSONL file `spill_path`, if given, and are
+    still returned by `tail`. Indexing and slicing return dicts with the prompt, response, kwargs and
+    raw_kwargs of the calls (plus any annotations), as the plain list of dicts used to.
+    """
+
+    def __init__(self, capacity: Optional[int] = None, spill_path: Optional[str] = None):
+        if capacity is None:
+            capacity = int(os.environ.get("DSP_LM_HISTORY_SIZE", 1000))
+        self.capacity = capacity
+        self.spill_path = spill_path or os.environ.get("DSP_LM_HISTORY_PATH")
+        self.records = deque()
+        # prompt hash -> [prompt, number of records in the buffer that refer to it]
+        self.prompts = {}
+        self.lock = threading.Lock()
+        # the record of the last call made by each thread, for `annotate`
+        self.local = threading.local()
+
+    def append(self, prompt: str, response, kwargs: dict, raw_kwargs: dict):
+        prompt_hash = hashlib.sha1(prompt.encode("utf-8")).hexdigest()
+        response_has_prompt = type(response) is dict and response.get("prompt") == prompt
+        if response_has_prompt:
+            response = {key: value for key, value in response.items() if key != "prompt"}
+
+        with self.lock:
+            entry = self.prompts.setdefault(prompt_hash, [prompt, 0])
+            entry[1] += 1
+            record = HistoryRecord(prompt_hash, response, kwargs, raw_kwargs, response_has_prompt)
+            self.records.append(record)
+            self.local.record = record
+
+            while len(self.records) > self.capacity:
+                self._evict(self.records.popleft())
+
+    def annotate(self, **extras):
+        """Attaches `extras` (e.g. the completions extracted from the response) to the record of the last
+        call made by this thread. Does nothing if the buffer is empty (e.g. a capacity of 0)."""
+        record = getattr(self.local, "record", None)
+        with self.lock:
+            if record is None or not self.records:
+                return
+            record.extras = {**(record.extras or {}), **extras}
+
+    def _evict(self, record: HistoryRecord):
+        entry = self.prompts[record.prompt_hash]
+        if self.spill_path:
+            with open(self.spill_path, "a") as f:
+                f.write(json.dumps(self._to_dict(record), default=_to_jsonable) + "\n")
+
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self.prompts[record.prompt_hash]
+
+    def _to_dict(self, record: HistoryRecord) -> dict[str, Any]:
+        prompt = self.prompts[record.prompt_hash][0]
+        return {
+            "prompt": prompt,
+            "response": {"prompt": prompt, **record.response} if record.response_has_prompt else record.response,
+            "kwargs": record.kwargs,
+            "raw_kwargs": record.raw_kwargs,
+            **(record.extras or {}),
+        }
+
+    def tail(self, n: int) -> list[dict[str, Any]]:
+        """Returns the last n records, reading the spill file when the buffer holds fewer."""
+        with self.lock:
+            records = [self._to_dict(record) for record in list(self.records)[-n:]]
+
+        if len(records) < n and self.spill_path and os.path.exists(self.spill_path):
+            with open(self.spill_path) as f:
+                spilled = deque(f, maxlen=n - len(records))
+            records = [json.loads(line) for line in spilled] + records
+
+        return records
+
+    def clear(self):
+        with self.lock:
+            self.records.clear()
+            self.prompts.clear()
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, idx):
+        with self.lock:
+            if isinstance(idx, slice):
+                return [self._to_dict(record) for record in list(self.records)[idx]]
+            return self._to_dict(self.records[idx])
+
+    def __iter__(self):
+        return iter(self[:])
+
+
+def _to_jsonable(obj):
+    # responses of some providers are objects rather than dicts
+    if hasattr(obj, "__dict__"):
+        return vars(obj)
+    return repr(obj)
+
+
+def _get_field(obj, name: str):
+    return obj[name] if isinstance(obj, dict) else getattr(obj, name)
 
 
 class LM(ABC):
@@ -16,7 +143,7 @@ class LM(ABC):
         }
         self.provider = "default"
 
-        self.history = []
+        self.history = LMHistory()
 
     @abstractmethod
     def basic_request(self, prompt, **kwargs):
@@ -40,14 +167,14 @@ class LM(ABC):
         last_prompt = None
         printed = []
 
-        for x in reversed(self.history[-100:]):
+        for x in reversed(self.history.tail(100)):
             prompt = x["prompt"]
 
             if prompt != last_prompt:
                 printed.append(
                     (
                         prompt,
-                        x["response"].generations
+                        _get_field(x["response"], "generations")
                         if provider == "cohere"
                         else x["response"]["choices"],
                     )
@@ -63,7 +190,7 @@ class LM(ABC):
             print(prompt, end="")
             text = ""
             if provider == "cohere":
-                text = choices[0].text
+                text = _get_field(choices[0], "text")
             elif provider == "openai":
                 text = self._get_choice_text(choices[0])
             else:
@@ -1,8 +1,90 @@
+import os
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+
+class CrossEncoderScoreCache:
+    """Bounded LRU cache of cross-encoder scores keyed on (model, query, passage hash).
+    If `path` is given, scores are also persisted to a SQLite file and survive restarts.
+    """
+    def __init__(self, model_name_or_path: str, maxsize: int = 100_000, path: Optional[str] = None):
+        self.model_name_or_path = model_name_or_path
+        self.maxsize = maxsize
+        self.scores = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self.conn = None
+        if path:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS scores "
+                "(model TEXT, query TEXT, passage_hash TEXT, score REAL, PRIMARY KEY (model, query, passage_hash))"
+            )
+            self.conn.commit()
+
+    @staticmethod
+    def passage_hash(passage: str) -> str:
+        return hashlib.sha1(passage.encode("utf-8")).hexdigest()
+
+    def get(self, query: str, passage_hash: str) -> Optional[float]:
+        key = (query, passage_hash)
+        with self.lock:
+            score = self.scores.get(key)
+            if score is None and self.conn is not None:
+                row = self.conn.execute(
+                    "SELECT score FROM scores WHERE model = ? AND query = ? AND passage_hash = ?",
+                    (self.model_name_or_path, query, passage_hash),
+                ).fetchone()
+                if row is not None:
+                    score = row[0]
+                    self._put(key, score)
+
+            if score is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.scores.move_to_end(key)
+
+        return score
+
+    def put_many(self, keys: list[tuple[str, str]], scores: list[float]):
+        with self.lock:
+            for key, score in zip(keys, scores):
+                self._put(key, score)
+
+            if self.conn is not None:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?)",
+                    [(self.model_name_or_path, query, passage_hash, score)
+                     for (query, passage_hash), score in zip(keys, scores)],
+                )
+                self.conn.commit()
+
+    def _put(self, key, score):
+        self.scores[key] = score
+        self.scores.move_to_end(key)
+        while len(self.scores) > self.maxsize:
+            self.scores.popitem(last=False)
+
+    def cache_info(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "maxsize": self.maxsize, "currsize": len(self.scores)}
+
+
 class SentenceTransformersCrossEncoder:
     """Wrapper for sentence-transformers cross-encoder model.
+    Scores are cached, so only (query, passage) pairs that were not seen before are run through the model.
     """
     def __init__(
-        self, model_name_or_path: str = "cross-encoder/ms-marco-MiniLM-L-12-v2"
+        self,
+        model_name_or_path: str = "cross-encoder/ms-marco-MiniLM-L-12-v2",
+        cache_size: int = 100_000,
+        cache_path: Optional[str] = None,
+        batch_size: int = 32,
     ):
         try:
             from sentence_transformers.cross_encoder import CrossEncoder
@@ -11,6 +93,59 @@ class SentenceTransformersCrossEncoder:
                 "You need to install sentence-transformers library to use SentenceTransformersCrossEncoder."
             )
         self.model = CrossEncoder(model_name_or_path)
+        self.batch_size = batch_size
+        self.cache = CrossEncoderScoreCache(
+            model_name_or_path,
+            maxsize=cache_size,
+            path=cache_path or os.environ.get("DSP_RERANKER_CACHE"),
+        )
 
     def __call__(self, query: str, passage: list[str]) -> list[float]:
-        return self.model.predict([[query, p] for p in passage]).tolist()
+        return self._score_pairs([(query, p) for p in passage])
+
+    def score_batch(self, queries_passages: list[tuple[str, list[str]]]) -> list[list[float]]:
+        """Scores several (query, passages) at once, sharing the model's forward passes across queries.
+        Returns the scores of each query's passages, in order.
+        """
+        pairs = [(query, p) for query, passage in queries_passages for p in passage]
+        scores = self._score_pairs(pairs)
+
+        lst_scores = []
+        offset = 0
+        for _, passage in queries_passages:
+            lst_scores.append(scores[offset: offset + len(passage)])
+            offset += len(passage)
+
+        return lst_scores
+
+    def _score_pairs(self, pairs: list[tuple[str, str]]) -> list[float]:
+        keys = [(query, self.cache.passage_hash(p)) for query, p in pairs]
+        scores = [self.cache.get(*key) for key in keys]
+
+        # run the model once for each distinct pair that is not cached yet
+        misses = {}
+        for key, pair, score in zip(keys, pairs, scores):
+            if score is None and key not in misses:
+                misses[key] = pair
+
+        if misses:
+            miss_keys = list(misses.keys())
+            miss_scores = self._predict([misses[key] for key in miss_keys])
+            self.cache.put_many(miss_keys, miss_scores)
+            miss_scores = dict(zip(miss_keys, miss_scores))
+            scores = [miss_scores[key] if score is None else score for key, score in zip(keys, scores)]
+
+        return scores
+
+    def _predict(self, pairs: list[tuple[str, str]]) -> list[float]:
+        # batches of similar length need less padding, so run the pairs sorted by length
+        order = sorted(range(len(pairs)), key=lambda idx: len(pairs[idx][0]) + len(pairs[idx][1]))
+        sorted_scores = self.model.predict(
+            [list(pairs[idx]) for idx in order], batch_size=self.batch_size
+        ).tolist()
+
+        scores = [0.0] * len(pairs)
+        for idx, score in zip(order, sorted_scores):
+            scores[idx] = score
+
+        return scores
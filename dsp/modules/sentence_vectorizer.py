@@ -1,25 +1,364 @@
 import abc
-from typing import List, Optional
+import atexit
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import uuid
+from typing import Callable, List, Optional, Union
 
 import numpy as np
 import openai
 
 
+class EmbeddingStore:
+    '''
+    Persistent on-disk store of text embeddings for a single model (`namespace`).
+    Vectors live in a memory-mapped matrix (`vectors.bin`) and rows are looked up by the
+    SHA-1 hash of the text, listed one per row in an append-only key file (`keys.txt`), so only
+    texts that were never seen before have to be encoded. The least recently used rows are evicted
+    on compaction once the store holds more than `max_rows` vectors; the use counters (`index.json`)
+    are written after every `flush_every` new rows (and at exit), not on every miss.
+    The store can be shared by threads, and by processes opening the same directory: the files are
+    only modified under an exclusive lock (`lock`), after catching up with the rows other processes
+    added. Texts are encoded outside of the locks.
+    '''
+    def __init__(
+        self,
+        root: str,
+        namespace: str,
+        dtype: str = 'float32',
+        max_rows: Optional[int] = None,
+        flush_every: int = 1024
+    ):
+        self.namespace = namespace
+        self.max_rows = max_rows
+        self.flush_every = flush_every
+        self.lock = threading.RLock()
+        self.dir = os.path.join(root, hashlib.sha1(namespace.encode('utf-8')).hexdigest()[:16])
+        self.vectors_path = os.path.join(self.dir, 'vectors.bin')
+        self.keys_path = os.path.join(self.dir, 'keys.txt')
+        self.index_path = os.path.join(self.dir, 'index.json')
+        os.makedirs(self.dir, exist_ok=True)
+
+        self.dtype = np.dtype(dtype)
+        self.dim = None
+        self.keys: List[str] = []
+        self.last_used: List[int] = []
+        self.tick = 0
+        self.index = {}
+
+        self._matrix = None
+        self._dirty = False
+        self._n_unflushed = 0
+        # the key file as of the last sync (id, bytes read and stat), to notice rows added by other processes
+        self._keys_id = None
+        self._keys_size = 0
+        self._keys_state = None
+        self._lock_file = open(os.path.join(self.dir, 'lock'), 'a')
+        self._lock_depth = 0
+
+        with self._locked():
+            self._sync()
+            self._truncate_vectors()
+
+        atexit.register(self.flush)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    @staticmethod
+    def text_hash(text: str) -> str:
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # the thread lock, then the file lock shared with other processes (taken once per thread)
+        with self.lock:
+            if self._lock_depth == 0:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _disk_state(self):
+        try:
+            stat = os.stat(self.keys_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def _read_keys(self, offset: int):
+        with open(self.keys_path, 'rb') as f:
+            header = f.readline()
+            if not header.endswith(b'\n'):
+                # cut off by a crash before any row was written
+                return None, [], 0
+            keys_id = header.decode('ascii').strip()
+            f.seek(max(offset, f.tell()))
+            offset = f.tell()
+            data = f.read()
+
+        end = data.rfind(b'\n') + 1
+        if end < len(data):
+            # a line cut off by a crash; the lock holder always finishes its lines
+            os.truncate(self.keys_path, offset + end)
+
+        return keys_id, data[:end].decode('ascii').split(), offset + end
+
+    def _write_keys(self, keys: List[str], mode: str, path: Optional[str] = None):
+        with open(path or self.keys_path, mode) as f:
+            if mode == 'w':
+                self._keys_id = uuid.uuid4().hex
+                f.write(self._keys_id + '\n')
+            f.write(''.join(key + '\n' for key in keys))
+
+    def _sync(self):
+        '''Catches up with the rows other processes added or compacted away. Needs the file lock.'''
+        state = self._disk_state()
+        if state == self._keys_state:
+            return
+
+        keys_id, new_keys, size = self._read_keys(self._keys_size) if state is not None else (None, [], 0)
+        if keys_id is None or keys_id != self._keys_id:
+            # first load, or the store was compacted: start over from the files
+            if os.path.exists(self.index_path):
+                with open(self.index_path) as f:
+                    meta = json.load(f)
+                assert meta['namespace'] == self.namespace, (meta['namespace'], self.namespace)
+                self.dtype = np.dtype(meta['dtype'])
+                self.dim = meta['dim']
+                self.tick = max(self.tick, meta['tick'])
+                self.last_used = meta['last_used']
+            else:
+                self.last_used = []
+
+            self.keys = []
+            self.index = {}
+            if keys_id is not None and self._keys_size > 0:
+                keys_id, new_keys, size = self._read_keys(0)
+            del self.last_used[len(new_keys):]
+
+        for key in new_keys:
+            self.index[key] = len(self.keys)
+            self.keys.append(key)
+        self.last_used.extend([self.tick] * (len(self.keys) - len(self.last_used)))
+
+        self._keys_id = keys_id
+        self._keys_size = size
+        self._keys_state = self._disk_state()
+        self._open_matrix()
+
+    def _truncate_vectors(self):
+        # vectors appended without their keys (e.g. before a crash) are not indexed; drop them,
+        # so that new rows are appended right after the indexed ones
+        n_bytes = len(self.keys) * (self.dim or 0) * self.dtype.itemsize
+        if os.path.exists(self.vectors_path) and os.path.getsize(self.vectors_path) > n_bytes:
+            os.truncate(self.vectors_path, n_bytes)
+
+    def _open_matrix(self):
+        self._matrix = None
+        if len(self.keys) > 0:
+            self._matrix = np.memmap(
+                self.vectors_path, dtype=self.dtype, mode='r', shape=(len(self.keys), self.dim)
+            )
+
+    def get_or_compute(
+        self, texts: List[str], encode_fn: Callable[[List[str]], np.ndarray]
+    ) -> np.ndarray:
+        '''Returns float32 embeddings for `texts`, encoding only those missing from the store.'''
+        hashes = [self.text_hash(text) for text in texts]
+
+        if self._disk_state() != self._keys_state:
+            with self._locked():
+                self._sync()
+
+        # the vectors of hits are read right away, as other threads may compact the store afterwards
+        vectors = {}
+        misses = {}
+        with self.lock:
+            self.tick += 1
+            hit_rows = {}
+            for key, text in zip(hashes, texts):
+                if key in self.index:
+                    hit_rows[key] = self.index[key]
+                elif key not in misses:
+                    misses[key] = text
+
+            if hit_rows:
+                rows = list(hit_rows.values())
+                for row in rows:
+                    self.last_used[row] = self.tick
+                self._dirty = True
+                vectors.update(zip(hit_rows.keys(), np.asarray(self._matrix[rows], dtype=np.float32)))
+
+        if misses:
+            # encode outside of the lock, so other threads' lookups don't wait for the model
+            emb = np.asarray(encode_fn(list(misses.values())))
+            self.add(list(misses.keys()), emb)
+            # round-trip through the store's dtype, so that hits and misses return the same vectors
+            vectors.update(zip(misses.keys(), emb.astype(self.dtype).astype(np.float32)))
+
+        if self.max_rows is not None and len(self.keys) > self.max_rows:
+            self.compact(self.max_rows)
+
+        if len(texts) == 0:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+
+        return np.stack([vectors[key] for key in hashes])
+
+    def add(self, hashes: List[str], emb: np.ndarray):
+        with self._locked():
+            self._sync()
+
+            if self.dim is None:
+                # written before any row, as other processes need the dimension to read the vectors
+                self.dim = emb.shape[1]
+                self._dirty = True
+                self._flush()
+            assert emb.shape == (len(hashes), self.dim), (emb.shape, len(hashes), self.dim)
+
+            # another thread or process may have added some of the texts while they were encoded
+            new_rows = {}
+            for row, key in enumerate(hashes):
+                if key not in self.index and key not in new_rows:
+                    new_rows[key] = row
+            if not new_rows:
+                return
+
+            # vectors first, then their keys: a crash in between leaves vectors that are truncated
+            self._truncate_vectors()
+            with open(self.vectors_path, 'ab') as f:
+                f.write(np.ascontiguousarray(emb[list(new_rows.values())], dtype=self.dtype).tobytes())
+            self._write_keys(list(new_rows), 'a' if self._keys_id is not None else 'w')
+            self._keys_state = self._disk_state()
+            self._keys_size = self._keys_state[1]
+
+            for key in new_rows:
+                self.index[key] = len(self.keys)
+                self.keys.append(key)
+                self.last_used.append(self.tick)
+
+            self._dirty = True
+            self._open_matrix()
+
+            self._n_unflushed += len(new_rows)
+            if self._n_unflushed >= self.flush_every:
+                self._flush()
+
+    def compact(self, max_rows: Optional[int] = None):
+        '''Rewrites the store keeping only the `max_rows` most recently used vectors.'''
+        with self._locked():
+            self._sync()
+            self._compact(max_rows)
+
+    def _compact(self, max_rows: Optional[int]):
+        if max_rows is not None and len(self.keys) <= max_rows:
+            return
+
+        rows = sorted(range(len(self.keys)), key=lambda row: self.last_used[row], reverse=True)
+        if max_rows is not None:
+            rows = rows[:max_rows]
+        rows = sorted(rows)
+
+        kept = np.array(self._matrix[rows]) if rows else None
+        # release the memory map before replacing the file underneath it
+        self._matrix = None
+
+        self.keys = [self.keys[row] for row in rows]
+        self.last_used = [self.last_used[row] for row in rows]
+        self.index = {key: row for row, key in enumerate(self.keys)}
+
+        tmp_path = self.vectors_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            if kept is not None:
+                f.write(kept.tobytes())
+        os.replace(tmp_path, self.vectors_path)
+
+        # a new key file, with a new id on its first line, so that other processes reload the store
+        tmp_path = self.keys_path + '.tmp'
+        self._write_keys(self.keys, 'w', tmp_path)
+        os.replace(tmp_path, self.keys_path)
+        self._keys_state = self._disk_state()
+        self._keys_size = self._keys_state[1]
+
+        self._dirty = True
+        self._open_matrix()
+        self._flush()
+
+    def flush(self):
+        with self._locked():
+            # the use counters are written by row, so they must match the current key file
+            self._sync()
+            self._flush()
+
+    def _flush(self):
+        if not self._dirty:
+            return
+
+        meta = {
+            'namespace': self.namespace,
+            'dtype': self.dtype.name,
+            'dim': self.dim,
+            'tick': self.tick,
+            'last_used': self.last_used,
+        }
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self.index_path)
+        self._dirty = False
+        self._n_unflushed = 0
+
+
+def get_embedding_store(
+    namespace: str, store: Optional[Union[str, EmbeddingStore]] = None, **store_args
+) -> Optional[EmbeddingStore]:
+    '''
+    Resolves the embedding store of a vectorizer. `store` may be an `EmbeddingStore`, a root
+    directory, or None, in which case the `DSP_EMBEDDING_STORE` env variable is used (if set).
+    '''
+    if isinstance(store, EmbeddingStore):
+        return store
+
+    root = store or os.environ.get('DSP_EMBEDDING_STORE')
+    if not root:
+        return None
+
+    return EmbeddingStore(root, namespace, **store_args)
+
+
 class BaseSentenceVectorizer(abc.ABC):
     '''
     Base Class for Vectorizers. The main purpose is to vectorize text (doc/query)
     for ANN/KNN indexes. `__call__` method takes `List[Example]` as a single input, then extracts
-    `field_to_vectorize` from every Example and convert them into embeddings.
+    `field_to_vectorize` from every Example and convert them into embeddings with `_vectorize`.
     You can customize extraction logic in the `_extract_text_from_examples` method.
+    If `embedding_store` is set, embeddings are read from it and only new texts are vectorized.
     '''
     # embeddings will be computed based on the string in this attribute of Example object
     field_to_vectorize = 'text_to_vectorize'
+    embedding_store: Optional[EmbeddingStore] = None
 
     def __init__(self) -> None:
         pass
 
-    @abc.abstractmethod
     def __call__(self, inp_examples: List["Example"]) -> np.ndarray:
+        text_to_vectorize = self._extract_text_from_examples(inp_examples)
+
+        if self.embedding_store is None:
+            return self._vectorize(text_to_vectorize)
+
+        return self.embedding_store.get_or_compute(text_to_vectorize, self._vectorize)
+
+    @abc.abstractmethod
+    def _vectorize(self, text_to_vectorize: List[str]) -> np.ndarray:
         pass
 
     def _extract_text_from_examples(self, inp_examples: List["Example"]) -> List[str]:
@@ -42,7 +381,8 @@ class SentenceTransformersVectorizer(BaseSentenceVectorizer):
         model_name_or_path: str = 'all-MiniLM-L6-v2',
         vectorize_bs: int = 256,
         max_gpu_devices: int = 1,
-        normalize_embeddings: bool = False
+        normalize_embeddings: bool = False,
+        embedding_store: Optional[Union[str, EmbeddingStore]] = None
     ):
         # this isn't a good practice, but with top-level import the whole DSP
         # module import will be slow (>5 sec), because SentenceTransformer is doing
@@ -66,10 +406,11 @@ class SentenceTransformersVectorizer(BaseSentenceVectorizer):
         self.model_name_or_path = model_name_or_path
         self.vectorize_bs = vectorize_bs
         self.normalize_embeddings = normalize_embeddings
+        self.embedding_store = get_embedding_store(
+            f'sbert:{model_name_or_path}:normalize={normalize_embeddings}', embedding_store
+        )
 
-    def __call__(self, inp_examples: List["Example"]) -> np.ndarray:
-        text_to_vectorize = self._extract_text_from_examples(inp_examples)
-
+    def _vectorize(self, text_to_vectorize: List[str]) -> np.ndarray:
         if self.is_gpu and self.num_devices > 1:
             target_devices = list(range(self.num_devices))
             pool = self.model.start_multi_process_pool(target_devices=target_devices)
@@ -110,6 +451,9 @@ class NaiveGetFieldVectorizer(BaseSentenceVectorizer):
         embeddings = np.concatenate(embeddings, axis=0).astype(np.float32)
         return embeddings
 
+    def _vectorize(self, text_to_vectorize: List[str]) -> np.ndarray:
+        raise TypeError("NaiveGetFieldVectorizer reads precomputed embeddings from the examples, it can't embed text")
+
 
 class OpenAIVectorizer(BaseSentenceVectorizer):
     '''
@@ -121,16 +465,17 @@ class OpenAIVectorizer(BaseSentenceVectorizer):
         self,
         model: str = 'text-embedding-ada-002',
         embed_batch_size: int = 1024,
-        api_key: Optional[str] = None
+        api_key: Optional[str] = None,
+        embedding_store: Optional[Union[str, EmbeddingStore]] = None
     ):
         self.model = model
         self.embed_batch_size = embed_batch_size
+        self.embedding_store = get_embedding_store(f'openai:{model}', embedding_store)
 
         if api_key:
             openai.api_key = api_key
 
-    def __call__(self, inp_examples: List["Example"]) -> np.ndarray:
-        text_to_vectorize = self._extract_text_from_examples(inp_examples)
+    def _vectorize(self, text_to_vectorize: List[str]) -> np.ndarray:
         # maybe it's better to preallocate numpy matrix, but we don't know emb_dim
         embeddings_list = []
 
@@ -150,3 +495,47 @@ class OpenAIVectorizer(BaseSentenceVectorizer):
 
         embeddings = np.array(embeddings_list, dtype=np.float32)
         return embeddings
+
+
+def _main():
+    import argparse
+
+    parser = argparse.ArgumentParser("Prewarm the on-disk embedding store of a vectorizer")
+    parser.add_argument("--store", type=str, required=True, help="Root directory of the embedding store.")
+    parser.add_argument("--model", type=str, default='all-MiniLM-L6-v2', help="SentenceTransformers model.")
+    parser.add_argument("--normalize_embeddings", default=False, action='store_true')
+    parser.add_argument("--texts", type=str, default=None, help="A text file with one text per line.")
+    parser.add_argument("--asqa", type=str, default=None, help="ASQA.json, whose train questions are embedded.")
+    parser.add_argument("--dtype", type=str, default='float32', choices=['float32', 'float16'])
+    parser.add_argument("--max_rows", type=int, default=None, help="Compact the store to this many rows.")
+    args = parser.parse_args()
+
+    texts = []
+    if args.texts is not None:
+        with open(args.texts) as f:
+            texts += [line.rstrip('\n') for line in f if line.strip()]
+    if args.asqa is not None:
+        with open(args.asqa) as f:
+            data = json.load(f)
+        texts += [ins['ambiguous_question'] for ins in data['train'].values()]
+
+    namespace = f'sbert:{args.model}:normalize={args.normalize_embeddings}'
+    store = EmbeddingStore(args.store, namespace, dtype=args.dtype)
+    vectorizer = SentenceTransformersVectorizer(
+        model_name_or_path=args.model,
+        normalize_embeddings=args.normalize_embeddings,
+        embedding_store=store,
+    )
+
+    n_before = len(store)
+    if texts:
+        store.get_or_compute(texts, vectorizer._vectorize)
+    print(f"#> Stored {len(store) - n_before} new embeddings ({len(store)} in total) at {store.dir}")
+
+    if args.max_rows is not None:
+        store.compact(args.max_rows)
+        print(f"#> Compacted the store to {len(store)} embeddings")
+
+
+if __name__ == "__main__":
+    _main()
@@ -1,10 +1,11 @@
 import random
-from typing import Callable, Any
+import functools
+from typing import Callable, Any, Collection, Optional, Union
 
 import numpy as np
 
 import dsp
-from dsp.utils import EM, F1, DPR_normalize, dotdict, has_answer, normalize_text
+from dsp.utils import EM, F1, AnswerMatcher, DPR_normalize, dotdict, normalize_text
 
 
 class Example(dotdict):
@@ -126,12 +127,50 @@ def answer_match(prediction, answers, frac=1.0):
     return F1(prediction, answers) >= frac
 
 
-def passage_has_answers(passage: str, answers: list[str]) -> bool:
+class Passage:
+    """A passage text with its normalized DPR tokens, computed lazily and only once."""
+
+    __slots__ = ("text", "_tokens", "_token_set")
+
+    def __init__(self, text: str):
+        self.text = text
+        self._tokens = None
+        self._token_set = None
+
+    @property
+    def tokens(self) -> list[str]:
+        if self._tokens is None:
+            self._tokens = DPR_normalize(normalize_text(self.text))
+        return self._tokens
+
+    @property
+    def token_set(self) -> frozenset[str]:
+        if self._token_set is None:
+            self._token_set = frozenset(self.tokens)
+        return self._token_set
+
+    def __str__(self) -> str:
+        return self.text
+
+
+@functools.lru_cache(maxsize=100_000)
+def get_passage(text: str) -> Passage:
+    """Returns the shared `Passage` of a text, so each passage is tokenized once per run."""
+    return Passage(text)
+
+
+@functools.lru_cache(maxsize=4096)
+def get_answer_matcher(answers: tuple[str, ...]) -> AnswerMatcher:
+    """Tokenizes the answers once and returns a matcher reusable across passages."""
+    return AnswerMatcher([DPR_normalize(normalize_text(ans)) for ans in answers])
+
+
+def passage_has_answers(passage: Union[str, Passage], answers: list[str]) -> bool:
     """Returns True if the passage contains the answer."""
-    return has_answer(
-        tokenized_answers=[DPR_normalize(normalize_text(ans)) for ans in answers],
-        text=normalize_text(passage),
-    )
+    if not isinstance(passage, Passage):
+        passage = get_passage(passage)
+
+    return get_answer_matcher(tuple(answers)).match(passage.tokens, passage.token_set)
 
 
 def cast_naive_get_only_question_text(inp_example: Example) -> Example:
@@ -156,16 +195,22 @@ def cast_naive_get_question_and_answer(inp_example: Example) -> Example:
 def knn(
     train: list[Example],
     cast: Callable[[Example], Example] = cast_naive_get_only_question_text,
+    id_field: str = "id",
     **knn_args
 ) -> Callable[[Example, int], list[Example]]:
     """
     A function that vectorizes train data using `dsm.settings.vectorizer`, then build an ANN/KNN
     index to search similar questions among `train` samples.
 
+    The index is built once and can be reused for many searches. Examples can be masked out of a
+    search by passing their `id_field` values as `exclude_ids`, so callers that drop demos over
+    time (e.g. after deduplication) don't need to re-vectorize and re-index `train`.
+
     Args:
         train: a bunch of questions to put in index & search later
         cast: function that contructs text before vectorization. By default,
             it uses only question. Check `cast_naive_get_question_and_answer` for more details.
+        id_field: field of each Example used to identify it in `exclude_ids`.
         n_probe: number of closest IVF-clusters to check for neighbours.
             Doesn't affect bruteforce-based search.
         knn_args: check `create_faiss_index` function for details on ANN/KNN arguments.
@@ -184,10 +229,27 @@ def knn(
     index.train(all_vectors)
     index.add(all_vectors)
 
-    def inner_knn_search(inp_example: Example, k: int) -> list[Example]:
-        inp_example_vector = vectorizer([cast(inp_example)])
-        _, nearest_samples_idxs = index.search(inp_example_vector, k)
-        train_sampled = [train[cur_idx] for cur_idx in nearest_samples_idxs[0]]
+    train_ids = [cur_elem.get(id_field) for cur_elem in train]
+
+    def inner_knn_search(
+        inp_example: Example, k: int, exclude_ids: Optional[Collection] = None
+    ) -> list[Example]:
+        inp_example_vector = vectorizer([cast(inp_example)]).astype(np.float32)
+
+        # over-fetch by the number of masked examples so k valid ones always remain
+        n_excluded = len(exclude_ids) if exclude_ids else 0
+        n_search = min(k + n_excluded, len(train))
+        _, nearest_samples_idxs = index.search(inp_example_vector, n_search)
+
+        train_sampled = []
+        for cur_idx in nearest_samples_idxs[0]:
+            if cur_idx < 0:
+                continue
+            if n_excluded and train_ids[cur_idx] in exclude_ids:
+                continue
+            train_sampled.append(train[cur_idx])
+            if len(train_sampled) >= k:
+                break
         return train_sampled
 
     return inner_knn_search
@@ -177,9 +177,7 @@ def extract_final_answer(example, completions, extract=None):
             p.strip().split("\n")[-1].split(":", 1)[-1].strip() for p in completions
         ]
 
-    dsp.settings.lm.history.append(
-        {**dsp.settings.lm.history[-1], "completions": completions}
-    )
+    dsp.settings.lm.history.annotate(completions=completions)
 
     return completions
 
@@ -228,8 +226,6 @@ def majority_vote_(completions: Completions, normalize: bool, prediction_field:
     if normalize:
         pred = normalized_to_original[pred]
 
-    dsp.settings.lm.history.append(
-        {**dsp.settings.lm.history[-1], "topk": topk, "completions": [pred]}
-    )
+    dsp.settings.lm.history.annotate(topk=topk, completions=[pred])
 
     return [pred]
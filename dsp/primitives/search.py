@@ -1,6 +1,21 @@
 import numpy as np
 import dsp
 
+def topk_indices(scores, k: int) -> np.ndarray:
+    """Returns the indices of the k highest scores, highest first, without sorting all the scores."""
+    scores = np.asarray(scores)
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.array([], dtype=int)
+
+    if k < len(scores):
+        idxs = np.argpartition(-scores, k - 1)[:k]
+    else:
+        idxs = np.arange(len(scores))
+
+    return idxs[np.argsort(-scores[idxs], kind="stable")]
+
+
 #Retrieves passages relevant to the current question in dev from colbert and return top-k
 def retrieve(query: str, k: int) -> list[str]:
     """Retrieves passages from the RM for the query and returns the top k passages."""
@@ -13,7 +28,7 @@ def retrieve(query: str, k: int) -> list[str]:
     if dsp.settings.reranker:
         #Gets top-k from SentenceBert, returns list of indexes of k-most relevant passages in passages
         passages_cs_scores = dsp.settings.reranker(query, passages)
-        passages_cs_scores_sorted = np.argsort(passages_cs_scores)[::-1]
+        passages_cs_scores_sorted = topk_indices(passages_cs_scores, k)
         #keeps only the top-k indexes in passages
         passages = [passages[idx] for idx in passages_cs_scores_sorted]
 
@@ -24,10 +39,17 @@ def retrieveRerankEnsemble(queries: list[str], k: int) -> list[str]:
     if not (dsp.settings.rm and dsp.settings.reranker):
         raise AssertionError("Both RM and Reranker are needed to retrieve & re-rank.")
     queries = [q for q in queries if q]
+    lst_retrieved_passages = [dsp.settings.rm(query, k=k*3) for query in queries]
+    queries_passages = [(query, [psg.long_text for psg in retrieved_passages])
+                        for query, retrieved_passages in zip(queries, lst_retrieved_passages)]
+    #scores the passages of all the queries in one batch, if the reranker can
+    if hasattr(dsp.settings.reranker, "score_batch"):
+        lst_passages_cs_scores = dsp.settings.reranker.score_batch(queries_passages)
+    else:
+        lst_passages_cs_scores = [dsp.settings.reranker(query, passages) for query, passages in queries_passages]
+
     passages = {}
-    for query in queries:
-        retrieved_passages = dsp.settings.rm(query, k=k*3)
-        passages_cs_scores = dsp.settings.reranker(query, [psg.long_text for psg in retrieved_passages])
+    for retrieved_passages, passages_cs_scores in zip(lst_retrieved_passages, lst_passages_cs_scores):
         for idx in np.argsort(passages_cs_scores)[::-1]:
             psg = retrieved_passages[idx]
             passages[psg.long_text] = passages.get(psg.long_text, []) + [
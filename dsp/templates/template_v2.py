@@ -1,5 +1,6 @@
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 import re
+import threading
 from typing import Union, Any
 import dsp
 from dsp.primitives.demonstrate import Example
@@ -9,6 +10,10 @@ Field = namedtuple("Field", "name separator input_variable output_variable descr
 
 # TODO: de-duplicate with dsp/templates/template.py
 
+# rendered demo blocks kept per template, keyed by the identity of the demos
+DEMO_BLOCK_CACHE_SIZE = 1024
+_demo_block_lock = threading.Lock()
+
 
 class TemplateV2:
     def __init__(
@@ -112,6 +117,14 @@ class TemplateV2:
         ):
             return ""
 
+        # the guidelines only depend on the fields, so they are rendered once
+        # (subclasses like template_v3.Template don't call TemplateV2.__init__, hence the lazy attribute)
+        guidelines = self.__dict__.get("_guidelines")
+        if guidelines is None:
+            guidelines = self._guidelines = self._render_guidelines()
+        return guidelines
+
+    def _render_guidelines(self) -> str:
         result = "Follow the following format.\n\n"
 
         example = dsp.Example()
@@ -177,16 +190,36 @@ class TemplateV2:
 
         return example
 
-    def __call__(self, example, show_guidelines=True) -> str:
-        example = dsp.Example(example)
+    def render_demos(self, demos: list[Example]) -> tuple[str, list[str]]:
+        """Returns the block of the (non-augmented) demos and the list of augmented demos.
 
-        # The training data should not contain the output variable
-        if self.fields[-1].input_variable in example:
-            del example[self.fields[-1].input_variable]
+        The result is memoized by the identity of the demos, as the same demo objects are rendered for
+        every completion of a question. Each entry holds on to its demos, so their ids are not reused
+        while it is cached; demos are expected not to be modified in place once rendered.
+        """
+        demos = tuple(demos)
+        key = tuple(map(id, demos))
+
+        with _demo_block_lock:
+            cache = self.__dict__.setdefault("_demo_blocks", OrderedDict())
+            entry = cache.get(key)
+            if entry is not None:
+                cache.move_to_end(key)
+                return entry[1]
+
+        block = self._render_demos(demos)
+
+        with _demo_block_lock:
+            cache[key] = (demos, block)
+            while len(cache) > DEMO_BLOCK_CACHE_SIZE:
+                cache.popitem(last=False)
 
+        return block
+
+    def _render_demos(self, demos: list[Example]) -> tuple[str, list[str]]:
         rdemos = [
             self.query(demo, is_demo=True)
-            for demo in example.demos
+            for demo in demos
             if (
                 ("augmented" not in demo or not demo.augmented)
                 and (  # validate that the training example has the same primitive input var as the template
@@ -198,15 +231,25 @@ class TemplateV2:
 
         ademos = [
             self.query(demo, is_demo=True)
-            for demo in example.demos
+            for demo in demos
             if "augmented" in demo and demo.augmented
         ]
 
+        return "\n\n".join(rdemos), ademos
+
+    def __call__(self, example, show_guidelines=True) -> str:
+        example = dsp.Example(example)
+
+        # The training data should not contain the output variable
+        if self.fields[-1].input_variable in example:
+            del example[self.fields[-1].input_variable]
+
+        rdemos, ademos = self.render_demos(example.demos)
+
         long_query = self._has_augmented_guidelines()
         if long_query:
             example["augmented"] = True
         query = self.query(example)
-        rdemos = "\n\n".join(rdemos)
         if len(rdemos) >= 1 and len(ademos) == 0 and not long_query:
             rdemos_and_query = "\n\n".join([rdemos, query])
             parts = [
@@ -183,15 +183,54 @@ class SimpleTokenizer(Tokenizer):
         return Tokens(data, self.annotators)
 
 
+class AnswerMatcher(object):
+    """
+    Precompiled matcher for a set of tokenized answers. Build it once per answer set and reuse it
+    for every passage: matching is a single pass over the passage tokens, looking up only
+    the answer lengths that start with the current token.
+    """
+
+    def __init__(self, tokenized_answers):
+        self.has_empty_answer = False
+        self.lengths_by_first_token = {}
+        self.answers = set()
+
+        for single_answer in tokenized_answers:
+            single_answer = tuple(single_answer)
+            if len(single_answer) == 0:
+                # an empty answer matches at any position, as in the sliding-window comparison
+                self.has_empty_answer = True
+                continue
+
+            self.answers.add(single_answer)
+            self.lengths_by_first_token.setdefault(single_answer[0], set()).add(len(single_answer))
+
+    def match(self, tokens, token_set=None):
+        """Returns True if any answer occurs as a contiguous span of `tokens`.
+        If the set of `tokens` is known, passages without any answer's first token are rejected upfront.
+        """
+        if self.has_empty_answer:
+            return True
+
+        if token_set is not None and token_set.isdisjoint(self.lengths_by_first_token):
+            return False
+
+        for i, token in enumerate(tokens):
+            lengths = self.lengths_by_first_token.get(token)
+            if lengths is None:
+                continue
+
+            for length in lengths:
+                if tuple(tokens[i: i + length]) in self.answers:
+                    return True
+
+        return False
+
+
 def has_answer(tokenized_answers, text):
     text = DPR_normalize(text)
 
-    for single_answer in tokenized_answers:
-        for i in range(0, len(text) - len(single_answer) + 1):
-            if single_answer == text[i: i + len(single_answer)]:
-                return True
-
-    return False
+    return AnswerMatcher(tokenized_answers).match(text)
 
 
 def locate_answers(tokenized_answers, text):
@@ -1,7 +1,11 @@
 import re
 import string
+import functools
 import unicodedata
 
+import numpy as np
+from scipy import sparse
+
 from collections import Counter
 from dsp.utils.utils import print_message
 
@@ -30,23 +34,76 @@ def nF1(history, prediction, answers_list, return_recall=False):
     return max(novel_f1_score(history, prediction, ans, return_recall=return_recall) for ans in answers_list)
 
 
-def normalize_text(s):
-    s = unicodedata.normalize('NFD', s)
-
-    def remove_articles(text):
-        return re.sub(r'\b(a|an|the)\b', ' ', text)
-
-    def white_space_fix(text):
-        return ' '.join(text.split())
-
-    def remove_punc(text):
-        exclude = set(string.punctuation)
-        return ''.join(ch for ch in text if ch not in exclude)
+ARTICLES_RE = re.compile(r'\b(a|an|the)\b')
+PUNCTUATION_RE = re.compile('[%s]' % re.escape(string.punctuation))
+PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
 
-    def lower(text):
-        return text.lower()
 
-    return white_space_fix(remove_articles(remove_punc(lower(s))))
+@functools.lru_cache(maxsize=2 ** 16)
+def normalize_text(s):
+    s = unicodedata.normalize('NFD', s).lower()
+    # str.translate is fastest on ASCII text but falls back to a slow path otherwise
+    s = s.translate(PUNCTUATION_TABLE) if s.isascii() else PUNCTUATION_RE.sub('', s)
+    s = ARTICLES_RE.sub(' ', s)
+
+    return ' '.join(s.split())
+
+
+def normalize_many(texts):
+    """Normalizes a batch of texts, normalizing each distinct text only once."""
+    normalized = {}
+    for text in texts:
+        if text not in normalized:
+            normalized[text] = normalize_text(text)
+
+    return [normalized[text] for text in texts]
+
+
+class TokenF1Scorer:
+    """
+    Batched token-overlap F1 (as in `f1_score`) between a fixed set of reference texts and new texts.
+    References are normalized and vectorized once into a sparse bag-of-tokens CSR matrix over a shared
+    vocabulary. The k-th occurrence of a token is its own feature, so the dot product of two rows is
+    the size of their multiset intersection and F1 for all pairs is a single sparse product.
+    """
+
+    def __init__(self, references):
+        self.vocab = {}
+        self.matrix, self.lengths = self._vectorize(references, grow_vocab=True)
+
+    def _vectorize(self, texts, grow_vocab=False):
+        rows, cols, lengths = [], [], []
+        for row, text in enumerate(texts):
+            tokens = normalize_text(text).split()
+            lengths.append(len(tokens))
+
+            seen = Counter()
+            for token in tokens:
+                seen[token] += 1
+                feature = (token, seen[token])
+                if feature not in self.vocab:
+                    if not grow_vocab:
+                        # can't overlap with any reference, but still counts towards the length
+                        continue
+                    self.vocab[feature] = len(self.vocab)
+                rows.append(row)
+                cols.append(self.vocab[feature])
+
+        matrix = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.float64), (rows, cols)),
+            shape=(len(texts), len(self.vocab)),
+        )
+        return matrix, np.array(lengths, dtype=np.float64)
+
+    def score(self, predictions):
+        """Returns the F1 of every (reference, prediction) pair as a (n_references, n_predictions) array."""
+        matrix, lengths = self._vectorize(predictions)
+        num_same = (self.matrix @ matrix.T).toarray()
+        denominator = self.lengths[:, None] + lengths[None, :]
+
+        f1 = np.zeros_like(num_same)
+        np.divide(2 * num_same, denominator, out=f1, where=num_same > 0)
+        return f1
 
 
 def em_score(prediction, ground_truth):
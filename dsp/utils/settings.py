@@ -1,7 +1,14 @@
 from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from functools import wraps
 from dsp.utils.utils import dotdict
 
 
+# Overrides pushed by `settings.context(...)`. Each thread / asyncio task sees its own stack;
+# it is an immutable tuple, so copying a context to inherit it on spawn is cheap.
+_context_stack: ContextVar[tuple] = ContextVar("dsp_settings_context_stack", default=())
+
+
 class Settings(object):
     """DSP configuration settings."""
 
@@ -16,6 +23,8 @@ class Settings(object):
         if cls._instance is None:
             cls._instance = super().__new__(cls)
             cls._instance.stack = []
+            # process-wide in-process caches (e.g. of LM responses), by name
+            cls._instance.memory_caches = {}
 
             #  TODO: remove first-class support for re-ranker and potentially combine with RM to form a pipeline of sorts
             #  eg: RetrieveThenRerankPipeline(RetrievalModel, Reranker)
@@ -27,6 +36,7 @@ class Settings(object):
                 compiled_lm=None,
                 force_reuse_cached_compilation=False,
                 compiling=False,
+                rate_limiter=None,
             )
             cls._instance.__append(config)
 
@@ -34,6 +44,10 @@ class Settings(object):
 
     @property
     def config(self):
+        local_stack = _context_stack.get()
+        if local_stack:
+            return local_stack[-1]
+
         return self.stack[-1]
 
     def __getattr__(self, name):
@@ -48,12 +62,12 @@ class Settings(object):
     def __append(self, config):
         self.stack.append(config)
 
-    def __pop(self):
-        self.stack.pop()
-
     def configure(self, inherit_config: bool = True, **kwargs):
         """Set configuration settings.
 
+        Inside a `context`, the configuration only applies to the current thread / task until the context exits.
+        Otherwise, it is set process-wide.
+
         Args:
             inherit_config (bool, optional): Set configurations for the given, and use existing configurations for the rest. Defaults to True.
         """
@@ -62,16 +76,41 @@ class Settings(object):
         else:
             config = {**kwargs}
 
-        self.__append(config)
+        local_stack = _context_stack.get()
+        if local_stack:
+            _context_stack.set(local_stack + (config,))
+        else:
+            self.__append(config)
 
     @contextmanager
     def context(self, inherit_config=True, **kwargs):
-        self.configure(inherit_config=inherit_config, **kwargs)
+        """Overrides configuration settings for the current thread / asyncio task only."""
+        if inherit_config:
+            config = {**self.config, **kwargs}
+        else:
+            config = {**kwargs}
+
+        token = _context_stack.set(_context_stack.get() + (config,))
 
         try:
             yield
         finally:
-            self.__pop()
+            _context_stack.reset(token)
+
+    def inherit(self, func):
+        """Wraps `func` to run with the caller's current settings, e.g. when submitting it to a thread pool."""
+        ctx = copy_context()
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            # a context can't be entered by two threads at once, so each call runs in its own copy
+            return ctx.copy().run(func, *args, **kwargs)
+
+        return wrapper
+
+    def cache_stats(self) -> dict:
+        """Returns hits, misses, evictions and resident bytes of each registered in-process cache."""
+        return {name: cache.stats() for name, cache in self.memory_caches.items()}
 
     def __repr__(self) -> str:
         return repr(self.config)
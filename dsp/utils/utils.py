@@ -1,7 +1,9 @@
 import os
+import time
 import tqdm
 import datetime
 import itertools
+import threading
 
 from collections import defaultdict
 
@@ -185,6 +187,26 @@ def lengths2offsets(lengths):
     return
 
 
+class RateLimiter(object):
+    """
+    Thread-safe limiter that spaces out calls evenly, to at most `max_calls` per `period` seconds.
+    """
+
+    def __init__(self, max_calls, period=60.0):
+        self.interval = period / max_calls
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+
+        if wait > 0:
+            time.sleep(wait)
+
+
 # see https://stackoverflow.com/a/45187287
 class NullContextManager(object):
     def __init__(self, dummy_resource=None):
@@ -1,12 +1,84 @@
+import os
 import json
+import sqlite3
+import argparse
+import threading
 
-def get_snippets(qid):
-    f_snippet = open("complexwebquestions_V1_1/web_snippets_dev.json/web_snippets_dev.json")
-    data_snippet = json.load(f_snippet)
+SNIPPETS_PATH = "complexwebquestions_V1_1/web_snippets_dev.json/web_snippets_dev.json"
+SNIPPETS_DB_PATH = "complexwebquestions_V1_1/web_snippets_dev.db"
+
+_local = threading.local()
+# the store is built once, by the first thread that finds it missing
+_build_lock = threading.Lock()
+
+
+def build_snippet_store(json_path=SNIPPETS_PATH, db_path=SNIPPETS_DB_PATH):
+    """One-time conversion of the web snippets JSON into a SQLite store indexed by question_ID."""
+    with open(json_path) as f:
+        data_snippet = json.load(f)
+
+    tmp_path = db_path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    conn = sqlite3.connect(tmp_path)
+    conn.execute("CREATE TABLE snippets (question_ID TEXT PRIMARY KEY, snippets TEXT NOT NULL)")
+    rows = []
     for i in data_snippet:
-        if i["question_ID"] == qid:
-            snippets = []
-            for j in i["web_snippets"]:
-                snippets.append(j["snippet"])
-            return snippets
-    return []
+        snippets = [j["snippet"] for j in i["web_snippets"]]
+        rows.append((i["question_ID"], json.dumps(snippets)))
+    # keep the first entry of a question, as the linear scan used to
+    conn.executemany("INSERT OR IGNORE INTO snippets VALUES (?, ?)", rows)
+    conn.commit()
+    conn.close()
+
+    os.replace(tmp_path, db_path)
+    print(f"Indexed snippets of {len(rows)} questions into {db_path}")
+
+
+def _get_conn(db_path=SNIPPETS_DB_PATH):
+    # sqlite connections can't be shared across threads, so each thread opens its own
+    conns = getattr(_local, "conns", None)
+    if conns is None:
+        conns = _local.conns = {}
+
+    if db_path not in conns:
+        with _build_lock:
+            if not os.path.exists(db_path):
+                build_snippet_store(db_path=db_path)
+        conns[db_path] = sqlite3.connect(db_path)
+
+    return conns[db_path]
+
+
+def get_snippets(qid, db_path=SNIPPETS_DB_PATH):
+    row = _get_conn(db_path).execute(
+        "SELECT snippets FROM snippets WHERE question_ID = ?", (qid,)
+    ).fetchone()
+    if row is None:
+        return []
+    return json.loads(row[0])
+
+
+def iter_snippets(qids, db_path=SNIPPETS_DB_PATH, batch_size=500):
+    """Streams (qid, snippets) for the given qids in order, querying the store in batches."""
+    conn = _get_conn(db_path)
+    qids = list(qids)
+    for offset in range(0, len(qids), batch_size):
+        batch = qids[offset: offset + batch_size]
+        placeholders = ",".join("?" * len(batch))
+        rows = conn.execute(
+            f"SELECT question_ID, snippets FROM snippets WHERE question_ID IN ({placeholders})", batch
+        ).fetchall()
+        found = dict(rows)
+        for qid in batch:
+            yield qid, json.loads(found[qid]) if qid in found else []
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Index the web snippets by question_ID")
+    parser.add_argument("--json_path", default=SNIPPETS_PATH, type=str, help="The web snippets json file.")
+    parser.add_argument("--db_path", default=SNIPPETS_DB_PATH, type=str, help="The output SQLite store.")
+    args = parser.parse_args()
+
+    build_snippet_store(args.json_path, args.db_path)
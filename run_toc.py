@@ -2,6 +2,9 @@ import os
 import json
 import dsp
 import argparse
+import functools
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 from get_snippets import get_snippets
 
@@ -11,9 +14,9 @@ from toc import (
     ToC, Node,
     retrieve_passages,
     get_rac_template,
-    check_unique, verify_with_evidence,
+    check_unique, verify_many,
 )
-from utils import save_results
+from utils import save_results, get_checkpoint_path, load_checkpoint, append_checkpoint
 
 
 def get_dataset():
@@ -59,17 +62,21 @@ def get_dataset_ASQA():
     return train, data
 
 
-def get_example(args, train, ins, passages,
-                reranker=None, consolidation=False):
-    # print(ins)
-    question = ins.question
+def get_knn_func(train):
+    #indexes all train dicts once; the vectorizer and FAISS index are reused for every search
     with dsp.settings.context(vectorizer=dsp.SentenceTransformersVectorizer()):
-        #indexes all train dicts
         knn_func = dsp.knn(train)
-        n_dynamic = args.n_shot
-        #given current question and number of shots n returns most relevant demos using sentencebert
-        demos = knn_func(ins, n_dynamic)
-        demos.reverse()
+    return knn_func
+
+def get_example(args, knn_func, ins, passages,
+                reranker=None, consolidation=False, exclude_ids=None):
+    # print(ins)
+    question = ins.question
+    n_dynamic = args.n_shot
+    #given current question and number of shots n returns most relevant demos using sentencebert,
+    #skipping demos that were removed as duplicates
+    demos = knn_func(ins, n_dynamic, exclude_ids=exclude_ids)
+    demos.reverse()
 
     dic_example = {'question': question,
                    'demos': demos,
@@ -106,40 +113,43 @@ def QD_predict(example: dsp.Example, qd_template,
 
     return out_example, completions
 
-def remove_demos(demos, target_ids):
-    new_demos = []
+def get_demo_scorer(demos):
+    #parses the disambigs of all demos once and vectorizes their answers for batched F1 scoring
+    demo_row_ids = []
+    demo_answers = []
     for demo in demos:
-        if demo.id not in target_ids:
-            new_demos += [demo]
-    return new_demos
+        for da in parse_disambig(demo.disambig):
+            demo_row_ids += [demo.id]
+            demo_answers += [da['answer']]
 
-def remove_dup_demos(demos, lst_disambigs):
+    return dsp.TokenF1Scorer(demo_answers), demo_row_ids
+
+def find_dup_demos(demo_scorer, demo_row_ids, lst_disambigs):
     answers = []
     for disambig in lst_disambigs:
         answers += [disambig['answer']]
 
-    target_ids = []
-    for demo in demos:
-        demo_disambigs = parse_disambig(demo.disambig)
-        for da in demo_disambigs:
-            if dsp.metrics.F1(da['answer'], answers) > 0.8:
-                target_ids += [demo.id]
+    if len(answers) == 0 or len(demo_row_ids) == 0:
+        return set()
 
-    demos = remove_demos(demos, target_ids)
+    f1 = demo_scorer.score(answers)
+    target_ids = {demo_row_ids[row] for row in np.flatnonzero(f1.max(axis=1) > 0.8)}
 
-    return demos
+    return target_ids
 
 def remove_dup_psgs(passages, contexts, lst_disambigs):
     answers = []
     for disambig in lst_disambigs:
         answers += [disambig['answer']]
 
+    contexts = set(contexts)
     target_idxs = []
     for idx, passage in enumerate(passages):
         if passage in contexts and \
             dsp.passage_has_answers(passage, answers):
                 target_idxs += [idx]
 
+    target_idxs = set(target_idxs)
     passages = [passage for idx, passage in enumerate(passages) if idx not in target_idxs]
 
     return passages
@@ -162,8 +172,13 @@ def get_argparser():
     parser.add_argument("--max_trials", default=3, type=int, help="The maximum number of restarts.")
     parser.add_argument("--top_k_docs", default=100, type=int, help="The maximum number of retrieved documents.")
     parser.add_argument("--top_k_reranked", default=5, type=int, help="The maximum number of reranked documents.")
-    parser.add_argument("--save_steps", default="", type=str, help="you can save intermediate results.")
+    parser.add_argument("--save_steps", default="", type=str,
+                        help="Deprecated: every finished question is appended to <prefix>checkpoint.jsonl.")
+    parser.add_argument("--resume", default=False, action='store_true',
+                        help="Skip the questions already in the checkpoint of a previous run.")
     parser.add_argument("--verify", default=True, action='store_true',)
+    parser.add_argument("--workers", default=1, type=int, help="The number of questions to run concurrently.")
+    parser.add_argument("--max_rpm", default=0, type=int, help="The maximum number of LM requests per minute (0 for no limit).")
     parser.add_argument(
         "--output_dir",
         default="D:/MS/685/Project/cs-685-toc-project/outputs",
@@ -173,6 +188,115 @@ def get_argparser():
     )
     return parser
 
+def run_question(args, idx, ambig_ins, knn_func, demo_scorer, rac_template, kw_args_ex):
+    """Runs the Tree-of-Clarifications search for one dev question and returns (pred, output, errors)."""
+    # settings overrides made while answering this question stay local to it
+    with dsp.settings.context():
+        return _run_question(args, idx, ambig_ins, knn_func, demo_scorer, rac_template, kw_args_ex)
+
+def _run_question(args, idx, ambig_ins, knn_func, demo_scorer, rac_template, kw_args_ex):
+    kw_args_ex = kw_args_ex.copy()
+    lst_err = []
+    bing_passages = None
+
+    print("\n", ambig_ins["question"])
+    #demos of the ASQA train set removed as duplicates of generated disambigs
+    removed_demo_ids = set()
+    if (idx + 1) % 10 == 0:
+        print(f"{str(idx +1)} steps")
+
+    #loads the passages from bing for the current index
+    # if args.bing_path is not None:
+    #     bing_passages = bing_results[idx]
+
+    #retrieve relevant passages to the current dict in ambig_ins from bing and colbert
+    all_passages = get_snippets(ambig_ins["id"])
+    cur_passages = all_passages.copy()  # 100 passages for Azad Kashmir example
+
+    #create root node of the first root ambig dict
+    toc = ToC(root=Node(ambig_ins))
+    #set pruning to True if verification is enabled
+    do_pruning = args.verify == True
+    n_restarts = 0 ; n_expansions = 0
+
+    kw_args_ex.update({'consolidation': False})
+
+    #while tree limits have not exceeded
+    while n_restarts < args.max_trials and \
+        toc.n_nodes < args.max_nodes and \
+        n_expansions <= 15:
+
+        n_expansions += 1
+        if toc.leaf_nodes == []:
+            toc.leaf_nodes = [toc.root]
+            toc.leaf_nodes += toc.valid_nodes
+            n_restarts += 1
+
+        cur_node = toc.leaf_nodes.pop(0)
+        #get the dict of the current node
+        cur_ins = cur_node.ins
+        if cur_node.depth > args.max_depth:
+            continue
+
+        #get n examples and context from the training set relevant to the current ambig dict in the current node
+        qd_example = get_example(args, knn_func, cur_ins, cur_passages,
+                                 exclude_ids=removed_demo_ids, **kw_args_ex)
+            
+        #adds the context for the current question to slt_psgs.
+        # slt_psgs is part of each node in the tree representing the context for that node.
+        toc.slt_psgs += qd_example.context
+
+        #gets the results from the LLM of disambig questions and answers, not sure what is stored in what
+        # Errors out on the line below because API key not present
+        qd_result, qd_completions = QD_predict(qd_example, rac_template, sc=False, temperature=args.temperature)
+        try:
+            #Try parsing the q/a pairs
+            lst_disambigs = parse_disambig(qd_result.disambig)
+            #Probably to get the final answer
+            if lst_disambigs == []:
+                lst_disambigs = parse_disambig(qd_result.answer.split("\nAnswer:")[0])
+        except:
+            lst_err += [[idx, toc, qd_result.disambig]]
+
+        if args.verify and len(lst_disambigs):
+            removed_demo_ids.update(find_dup_demos(*demo_scorer, lst_disambigs))
+            cur_passages = remove_dup_psgs(cur_passages, qd_example.context, lst_disambigs)
+
+            if do_pruning:
+                unique_disambigs = [disambig for disambig in lst_disambigs
+                                    if check_unique(toc.valid_qas, disambig)]
+                #verifies all the disambigs with one reranker pass and concurrent LM calls
+                verdicts = verify_many(dsp.settings.lm,
+                                       toc,
+                                       unique_disambigs,
+                                       dsp.settings.reranker)
+                valid_disambigs = [disambig for disambig, verdict in zip(unique_disambigs, verdicts)
+                                   if verdict]
+                lst_disambigs = valid_disambigs.copy()
+
+        if len(lst_disambigs) > 0:
+            toc.add_nodes(lst_disambigs, depth=cur_node.depth+1)
+            continue
+
+        if do_pruning:
+            if n_restarts >= args.max_trials or n_expansions >= 10:
+                n_restarts = 0
+                do_pruning = False
+                continue
+
+    tree_ins = toc._get_tree(args.max_nodes)
+
+    kw_args_ex.update({'consolidation': True})
+    ac_example = get_example(args, knn_func, tree_ins, all_passages,
+                             exclude_ids=removed_demo_ids, **kw_args_ex)
+
+    ac_result, ac_completions = QD_predict(ac_example, rac_template, sc=False)
+
+    pred = ac_result.answer
+    output = {"output": ac_completions.data[0], "stats":[{"nodes": toc.n_nodes, "depth": toc.leaf_depth}]}
+
+    return pred, output, lst_err
+
 def main():
     parser = get_argparser()
     args = parser.parse_args()
@@ -183,6 +307,9 @@ def main():
     # rm = dsp.ColBERTv2(url=args.colbert_server)
     kw_config = {'lm' : lm}
 
+    if args.max_rpm > 0:
+        kw_config['rate_limiter'] = dsp.RateLimiter(args.max_rpm)
+
     if args.top_k_reranked > 0:
         kw_config['reranker'] = dsp.SentenceTransformersCrossEncoder()
 
@@ -190,6 +317,8 @@ def main():
 
     dev, data = get_dataset()
     train, asqa_data = get_dataset_ASQA()
+    knn_func = get_knn_func(train)
+    demo_scorer = get_demo_scorer(train)
     rac_template = get_rac_template()
 
     kw_args_ex = {}
@@ -206,115 +335,43 @@ def main():
         n_dev = min(args.n_dev, len(dev))
 
     os.makedirs(args.output_dir, exist_ok=True)
-    save_steps = [int(save_step) for save_step in args.save_steps.split(",")] if args.save_steps != "" else []
 
-    preds = [] ; outputs = []
-    lst_err = []
-    bing_passages = None
-    #looping over dev, dev is probably list[dicts] idx in the index and ambig_ins is a dict probably
-    for idx, ambig_ins in enumerate(tqdm(dev[:n_dev])):
-        #cur_demos will have the train set from ASQA apparently
-        print("\n", ambig_ins["question"])
-        cur_demos = train.copy()
-        if (idx + 1) % 10 == 0:
-            print(f"{str(idx +1)} steps")
-
-        #loads the passages from bing for the current index
-        # if args.bing_path is not None:
-        #     bing_passages = bing_results[idx]
-
-        #retrieve relevant passages to the current dict in ambig_ins from bing and colbert
-        all_passages = get_snippets(ambig_ins["id"])
-        cur_passages = all_passages.copy()  # 100 passages for Azad Kashmir example
-    
-        #create root node of the first root ambig dict
-        toc = ToC(root=Node(ambig_ins))
-        #set pruning to True if verification is enabled
-        do_pruning = args.verify == True
-        n_restarts = 0 ; n_expansions = 0
-
-        kw_args_ex.update({'consolidation': False})
-
-        #while tree limits have not exceeded
-        while n_restarts < args.max_trials and \
-            toc.n_nodes < args.max_nodes and \
-            n_expansions <= 15:
-
-            n_expansions += 1
-            if toc.leaf_nodes == []:
-                toc.leaf_nodes = [toc.root]
-                toc.leaf_nodes += toc.valid_nodes
-                n_restarts += 1
-
-            cur_node = toc.leaf_nodes.pop(0)
-            #get the dict of the current node
-            cur_ins = cur_node.ins
-            if cur_node.depth > args.max_depth:
-                continue
-
-            #get n examples and context from the training set relevant to the current ambig dict in the current node
-            qd_example = get_example(args, cur_demos, cur_ins, cur_passages, **kw_args_ex)
-            
-            #adds the context for the current question to slt_psgs.
-            # slt_psgs is part of each node in the tree representing the context for that node.
-            toc.slt_psgs += qd_example.context
-
-            #gets the results from the LLM of disambig questions and answers, not sure what is stored in what
-            # Errors out on the line below because API key not present
-            qd_result, qd_completions = QD_predict(qd_example, rac_template, sc=False, temperature=args.temperature)
-            try:
-                #Try parsing the q/a pairs
-                lst_disambigs = parse_disambig(qd_result.disambig)
-                #Probably to get the final answer
-                if lst_disambigs == []:
-                    lst_disambigs = parse_disambig(qd_result.answer.split("\nAnswer:")[0])
-            except:
-                lst_err += [[idx, toc, qd_result.disambig]]
-
-            if args.verify and len(lst_disambigs):
-                cur_demos = remove_dup_demos(cur_demos, lst_disambigs)
-                cur_passages = remove_dup_psgs(cur_passages, qd_example.context, lst_disambigs)
-
-                if do_pruning:
-                    valid_disambigs = []
-                    for disambig in lst_disambigs:
-                        if check_unique(toc.valid_qas, disambig):
-                            ver_completion = verify_with_evidence(dsp.settings.lm,
-                                                                toc,
-                                                                disambig,
-                                                                dsp.settings.reranker)
-                            if "True" in ver_completion[0]:
-                                valid_disambigs += [disambig]
-                    lst_disambigs = valid_disambigs.copy()
-
-            if len(lst_disambigs) > 0:
-                toc.add_nodes(lst_disambigs, depth=cur_node.depth+1)
-                continue
+    #each finished question is appended to the checkpoint, so a crashed run can --resume where it left off
+    checkpoint_path = get_checkpoint_path(args)
+    done_ids = set(load_checkpoint(checkpoint_path)) if args.resume else set()
+    todo = [idx for idx in range(n_dev) if dev[idx].id not in done_ids]
+    if done_ids:
+        print(f"Resuming: skipping {n_dev - len(todo)} finished questions")
 
-            if do_pruning:
-                if n_restarts >= args.max_trials or n_expansions >= 10:
-                    n_restarts = 0
-                    do_pruning = False
-                    continue
-
-        tree_ins = toc._get_tree(args.max_nodes)
+    lst_err = []
 
-        kw_args_ex.update({'consolidation': True})
-        ac_example = get_example(args, cur_demos, tree_ins, all_passages, **kw_args_ex)
+    run_fn = functools.partial(run_question, args, knn_func=knn_func, demo_scorer=demo_scorer,
+                               rac_template=rac_template, kw_args_ex=kw_args_ex)
+    executor = None
+    if args.workers > 1:
+        # whole trees of different questions run concurrently; each is checkpointed as soon as it finishes
+        # (save_results restores the dataset order)
+        executor = ThreadPoolExecutor(max_workers=args.workers)
+        futures = {executor.submit(dsp.settings.inherit(run_fn), idx, dev[idx]): idx for idx in todo}
+        results = ((futures[future], future.result()) for future in as_completed(futures))
+    else:
+        results = ((idx, run_fn(idx, dev[idx])) for idx in todo)
 
-        ac_result, ac_completions = QD_predict(ac_example, rac_template, sc=False)
+    with open(checkpoint_path, 'a' if args.resume else 'w') as f:
+        if args.resume and f.tell() > 0:
+            # terminate a line cut off by a crash, so the next record starts on its own line
+            f.write("\n")
 
-        preds   += [ac_result.answer]
-        outputs += [{"output": ac_completions.data[0], "stats":[{"nodes": toc.n_nodes, "depth": toc.leaf_depth}]}]
+        for idx, (pred, output, errs) in tqdm(results, total=len(todo)):
+            append_checkpoint(f, dev[idx].id, pred, output)
+            lst_err += errs
 
-        if (idx + 1) in save_steps:
-            with open(os.path.join(args.output_dir, f"output_{str(idx+1)}.json"), 'w') as f:
-                json.dump(outputs, f, indent=4)
-            print(f"Saved output_{idx}.json!")
+    if executor is not None:
+        executor.shutdown()
 
     lm.inspect_history(n=1)
 
-    save_results(args, data, preds, outputs)
+    save_results(args, data, checkpoint_path)
 
 if __name__ == "__main__":
     main()
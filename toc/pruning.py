@@ -1,3 +1,8 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
 import dsp
 from dsp.utils import deduplicate
 
@@ -14,16 +19,48 @@ def check_unique(valid_qas, cur_qa):
     
     return is_unique
 
-def get_evidence(tree, cur_qa, reranker):
-    passages = deduplicate(tree.slt_psgs)
+def get_pos_passages(passages, cur_qa):
     pos_passages = [passage for passage in passages \
                     if dsp.passage_has_answers(passage, cur_qa['answer'])]
     if len(pos_passages) == 0:
         pos_passages = passages
+
+    return pos_passages
+
+def get_evidence(tree, cur_qa, reranker):
+    passages = deduplicate(tree.slt_psgs)
+    pos_passages = get_pos_passages(passages, cur_qa)
     evidence = rerank(reranker, cur_qa['question'], pos_passages, 1)
     
     return evidence
 
+def get_evidence_many(tree, qas, reranker):
+    """Top evidence passage for each of the qas, scored with a single cross-encoder batch (if the reranker supports it)."""
+    passages = deduplicate(tree.slt_psgs)
+    lst_pos_passages = [get_pos_passages(passages, cur_qa) for cur_qa in qas]
+
+    queries_passages = [(cur_qa['question'], pos_passages)
+                        for cur_qa, pos_passages in zip(qas, lst_pos_passages)]
+    if hasattr(reranker, "score_batch"):
+        lst_scores = reranker.score_batch(queries_passages)
+    else:
+        lst_scores = [reranker(question, pos_passages) for question, pos_passages in queries_passages]
+    evidences = [[pos_passages[int(np.argmax(scores))]]
+                 for pos_passages, scores in zip(lst_pos_passages, lst_scores)]
+
+    return evidences
+
+def complete_many(lm, prompts):
+    """Sends all prompts to the LM concurrently (or as batches, for local models) and returns their completions in order."""
+    if hasattr(lm, "agenerate"):
+        return asyncio.run(lm.agenerate(prompts))
+
+    if hasattr(lm, "generate_many"):
+        return lm.generate_many(prompts)
+
+    with ThreadPoolExecutor(max_workers=len(prompts)) as executor:
+        return list(executor.map(dsp.settings.inherit(lm), prompts))
+
 def verify_with_evidence(lm, tree, cur_qa, reranker):
 
     evidence = get_evidence(tree, cur_qa, reranker)
@@ -31,4 +68,17 @@ def verify_with_evidence(lm, tree, cur_qa, reranker):
     
     completion = lm(prompt)
     
-    return completion
\ No newline at end of file
+    return completion
+
+def verify_many(lm, tree, qas, reranker):
+    """Batched `verify_with_evidence`: returns whether each of the qas is verified, in order."""
+    if len(qas) == 0:
+        return []
+
+    evidences = get_evidence_many(tree, qas, reranker)
+    prompts = [get_ver_prompt(evidence[0], tree.root.ins.question, cur_qa)
+               for evidence, cur_qa in zip(evidences, qas)]
+
+    completions = complete_many(lm, prompts)
+
+    return ["True" in completion[0] for completion in completions]
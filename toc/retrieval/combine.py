@@ -1,9 +1,12 @@
-import numpy as np
+from dsp.primitives.search import topk_indices
 
 #used for creating context, ranks top-k using sentencebert from all relevant passages
-def rerank(reranker, query, passages, k):
+def rerank(reranker, query, passages, k, return_scores=False):
     passages_cs_scores = reranker(query, passages)
-    passages_cs_scores_sorted = np.argsort(passages_cs_scores)[::-1]
-    passages = [passages[idx] for idx in passages_cs_scores_sorted]
-    
-    return passages[:k]
+    passages_cs_scores_sorted = topk_indices(passages_cs_scores, k)
+    topk_passages = [passages[idx] for idx in passages_cs_scores_sorted]
+
+    if return_scores:
+        return topk_passages, [passages_cs_scores[idx] for idx in passages_cs_scores_sorted]
+
+    return topk_passages
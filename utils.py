@@ -1,23 +1,51 @@
 import os
 import json
 
-def save_results(args, data, preds, outputs):
+def get_checkpoint_path(args):
+    return os.path.join(args.output_dir, args.prefix + "checkpoint.jsonl")
+
+def load_checkpoint(path):
+    """Returns {ID: record} of the questions already finished in the checkpoint JSONL."""
+    records = {}
+    if not os.path.exists(path):
+        return records
+
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line may have been cut off by a crash
+                continue
+            records[record['ID']] = record
+
+    return records
+
+def append_checkpoint(f, qid, pred, output):
+    """Appends the result of one finished question to the (open) checkpoint JSONL and flushes it."""
+    f.write(json.dumps({'ID': qid, 'pred': pred, 'output': output}) + "\n")
+    f.flush()
+
+def save_results(args, data, checkpoint_path=None):
+    """Writes the preds and outputs JSON files, in the order of data, from the checkpoint JSONL."""
+    records = load_checkpoint(checkpoint_path or get_checkpoint_path(args))
+
     preds_w_ids = {}
     outputs_w_ids = {}
-    for idx in range(len(data)):
-        d = data[idx]
-        if idx >= len(preds):
-            break
-        
-        preds_w_ids[d['ID']] = preds[idx]
-        outputs_w_ids[d['ID']] = outputs[idx]
-        
+    for d in data:
+        if d['ID'] not in records:
+            continue
+
+        preds_w_ids[d['ID']] = records[d['ID']]['pred']
+        outputs_w_ids[d['ID']] = records[d['ID']]['output']
+
     os.makedirs(args.output_dir, exist_ok=True)
-    
+
     with open(os.path.join(args.output_dir, args.prefix + "preds.json"), 'w') as f:
         json.dump(preds_w_ids, f)
-        
+
     with open(os.path.join(args.output_dir, args.prefix + "outputs.json"), 'w') as f:
         json.dump(outputs_w_ids, f)
-        
 